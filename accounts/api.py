@@ -0,0 +1,143 @@
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.views.generic import TemplateView
+
+from .forms import DateForm
+from .views import LedgerCacheMixin, get_ledger_head, AccountView, CategoryView, SubcategoryView, AliasView
+from . import modules
+
+
+def ledger_etag(request, *args, **kwargs):
+    # every write bumps the ledger version, unchanged ledgers answer 304 after reading only the version
+    return str(get_ledger_head(request)['version'])
+
+
+def get_request_date(request):
+    # the ?date= parameter or the latest transaction date, with the errors of a bad date
+    if 'date' in request.GET:
+        form = DateForm(request.GET)
+        if not form.is_valid():
+            return None, form.errors
+        return form.cleaned_data['date'], None
+    return get_ledger_head(request)['date'], None
+
+
+def money(value):
+    return '{:.2f}'.format(value or 0)
+
+
+def json_response(data, **kwargs):
+    return JsonResponse(data, json_dumps_params={'separators': (',', ':')}, **kwargs)
+
+
+class LedgerApiMixin:
+    # JSON views over the same engines as the pages, at the latest transaction date or ?date=
+
+    @method_decorator(condition(etag_func=ledger_etag))
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        self.balance_date, errors = get_request_date(request)
+        if errors:
+            return json_response({'errors': errors}, status=400)
+        return super().get(request, *args, **kwargs)
+
+    def get_balance_date(self):
+        return self.balance_date
+
+    def render_to_response(self, context, **response_kwargs):
+        data = {'date': self.balance_date.isoformat()}
+        data.update(self.get_data(context))
+        return json_response(data)
+
+
+def get_balances_data(balance_date):
+    account_list = modules.add_account_totals(balance_date)
+    assets, liabilities = modules.get_balance_summary(account_list)
+    return {
+        'accounts': [
+            {'id': account.pk, 'name': account.name, 'type': account.type, 'total': money(account.total)}
+            for account in account_list
+        ],
+        'assets': money(assets),
+        'liabilities': money(liabilities),
+        'capital': money(assets - liabilities),
+    }
+
+
+def get_report_data(balance_date):
+    category_list, income, expenses = modules.get_expenses_report(balance_date)
+    return {
+        'categories': [
+            {
+                'id': category.pk, 'name': category.name, 'type': category.type, 'total': money(category.total),
+                'subcategories': [
+                    {'id': subcategory.pk, 'name': subcategory.name, 'total': money(subcategory.total)}
+                    for subcategory in category.subcategories
+                ],
+                'aliases': [
+                    {'id': alias.pk, 'name': alias.name, 'subcategory': alias.subcategory_id, 'total': money(alias.total)}
+                    for alias in category.aliases
+                ],
+            }
+            for category in category_list
+        ],
+        'income': money(income),
+        'expenses': money(expenses),
+        'profit': money(income - expenses),
+    }
+
+
+def get_transactions_data(context):
+    data = {
+        'transactions': [
+            {
+                'id': transaction.pk, 'date': transaction.date.isoformat(), 'account': transaction.account_id,
+                'alias': transaction.alias.name, 'amount': money(transaction.signed), 'balance': money(transaction.balance),
+            }
+            for transaction in context['transaction_list']
+        ],
+        'previous_cursor': context['previous_cursor'],
+        'next_cursor': context['next_cursor'],
+    }
+    if 'balance' in context:
+        data['balance'] = money(context['balance'])
+    else:
+        data['total'] = money(context['total'])
+    return data
+
+
+class BalancesApiView(LedgerApiMixin, LedgerCacheMixin, TemplateView):
+
+    def get_data(self, context):
+        return get_balances_data(self.balance_date)
+
+
+class ReportApiView(LedgerApiMixin, LedgerCacheMixin, TemplateView):
+
+    def get_data(self, context):
+        return get_report_data(self.balance_date)
+
+
+class TransactionsApiMixin(LedgerApiMixin):
+
+    def get_data(self, context):
+        return get_transactions_data(context)
+
+
+class AccountApiView(TransactionsApiMixin, AccountView):
+    pass
+
+
+class CategoryApiView(TransactionsApiMixin, CategoryView):
+    pass
+
+
+class SubcategoryApiView(TransactionsApiMixin, SubcategoryView):
+    pass
+
+
+class AliasApiView(TransactionsApiMixin, AliasView):
+    pass
@@ -0,0 +1,115 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.shortcuts import render
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+import asyncio
+
+from . import profiling
+from .api import get_balances_data, get_report_data, get_request_date, get_transactions_data, json_response, ledger_etag
+from .views import IndexView, get_balance_context, get_report_context, page_cache_key
+
+
+# async versions of the reporting views, served under ASGI when ACCOUNTS_ASYNC_VIEWS is set
+
+def in_thread(function, *args):
+    # each aggregation gets its own worker thread and connection so independent queries overlap
+    def run():
+        try:
+            return function(*args)
+        finally:
+            connections.close_all()
+    return sync_to_async(run, thread_sensitive=False)()
+
+
+async def cached_response(request, balance_date, get_response):
+    # same keys as LedgerCacheMixin, sync and async workers share the cached pages
+    timeout = settings.ACCOUNTS_PAGE_CACHE_SECONDS
+    if not timeout:
+        return await get_response()
+    key = await in_thread(page_cache_key, request, balance_date)
+    response = await sync_to_async(cache.get)(key)
+    if response is None:
+        response = await get_response()
+        if response.status_code == 200:
+            await sync_to_async(cache.set)(key, response, timeout)
+    return response
+
+
+async def dashboard(request, template_name):
+    view = IndexView(template_name=template_name)
+    view.setup(request)
+    balance_date = await in_thread(view.get_balance_date)
+
+    async def get_response():
+        balances, report = await asyncio.gather(
+            in_thread(get_balance_context, balance_date),
+            in_thread(get_report_context, balance_date),
+        )
+        context = {'balance_date': balance_date}
+        context.update(balances)
+        context.update(report)
+        with profiling.timed('template'):
+            return render(request, template_name, context)
+    return await cached_response(request, balance_date, get_response)
+
+
+async def get_transaction_context(view, balance_date):
+    entity = await in_thread(view.get_entity)
+    page, totals = await asyncio.gather(
+        in_thread(view.get_transactions, entity, balance_date),
+        in_thread(view.get_totals, entity, balance_date),
+    )
+    context = {'balance_date': balance_date}
+    context.update(page)
+    context.update(totals)
+    return context
+
+
+async def transaction_list(request, pk, view_class, template_name):
+    view = view_class(template_name=template_name)
+    view.setup(request, pk=pk)
+    balance_date = await in_thread(view.get_balance_date)
+
+    async def get_response():
+        context = await get_transaction_context(view, balance_date)
+        with profiling.timed('template'):
+            return render(request, template_name, context)
+    return await cached_response(request, balance_date, get_response)
+
+
+async def api_response(request, get_data):
+    # conditional GET on the ledger version as the sync views get from the condition decorator
+    etag = quote_etag(await in_thread(ledger_etag, request))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        balance_date, errors = await in_thread(get_request_date, request)
+        if errors:
+            response = json_response({'errors': errors}, status=400)
+        else:
+            async def get_response():
+                data = {'date': balance_date.isoformat()}
+                data.update(await get_data(balance_date))
+                return json_response(data)
+            response = await cached_response(request, balance_date, get_response)
+    response['ETag'] = etag
+    return response
+
+
+async def api_balances(request):
+    return await api_response(request, lambda balance_date: in_thread(get_balances_data, balance_date))
+
+
+async def api_report(request):
+    return await api_response(request, lambda balance_date: in_thread(get_report_data, balance_date))
+
+
+async def api_transaction_list(request, pk, view_class):
+    view = view_class()
+    view.setup(request, pk=pk)
+
+    async def get_data(balance_date):
+        return get_transactions_data(await get_transaction_context(view, balance_date))
+    return await api_response(request, get_data)
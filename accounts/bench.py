@@ -0,0 +1,204 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction as db_transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+import datetime
+import django
+import platform
+import random
+import statistics
+import time
+
+from .models import Account, Alias, Category, Money, Parameters, Payee, StagedLine, Subcategory, Transaction
+from . import modules
+
+
+# deterministic synthetic ledgers and the timings the bench command reports on them
+
+LEDGER_START = datetime.date(2020, 1, 1)
+
+PAYEE_WORDS = [
+    'MORRISON', 'SAINSBURYS', 'TESCO', 'CAFFE', 'NERO', 'PRET', 'BOOTS', 'SHELL', 'CURZON', 'CINEMA',
+    'AMAZON', 'MARKETPLACE', 'TRANSPORT', 'RAIL', 'PHARMACY', 'BAKERY', 'GARAGE', 'BOOKSHOP', 'DELI', 'GYM',
+]
+PAYEE_PLACES = ['LONDON', 'LEEDS', 'YORK', 'BATH', 'DERBY', 'CARDIFF']
+
+
+def payee_name(rng, i):
+    # numbered so names are unique, with the noise words bank statements add
+    return '{} {} {:04d} {}'.format(rng.choice(PAYEE_WORDS), rng.choice(PAYEE_WORDS), i, rng.choice(PAYEE_PLACES))
+
+
+def generate_ledger(accounts=3, categories=6, subcategories=3, payees=300, years=2, per_month=200, seed=0):
+    rng = random.Random(seed)
+    Account.objects.bulk_create(
+        Account(name='Account {}'.format(i), type=Account.LIABILITY if i % 3 == 2 else Account.ASSET,
+                initial_balance=Money.from_cents(rng.randrange(0, 500000)))
+        for i in range(accounts)
+    )
+    # the first category is income, the others are expenses
+    Category.objects.bulk_create(
+        Category(name='Category {}'.format(i), type=Category.INCOME if i == 0 else Category.EXPENSE) for i in range(categories)
+    )
+    Subcategory.objects.bulk_create(
+        Subcategory(name='{} {}'.format(category.name, j), category=category)
+        for category in Category.objects.order_by('pk') for j in range(subcategories)
+    )
+    subcategory_list = list(Subcategory.objects.select_related('category').order_by('pk'))
+
+    # two payee spellings per alias, as a bank writes the same shop differently
+    Alias.objects.bulk_create(
+        Alias(name='Alias {}'.format(i), category=subcategory.category, subcategory=subcategory)
+        for i, subcategory in enumerate(rng.choice(subcategory_list) for i in range((payees + 1) // 2))
+    )
+    alias_list = list(Alias.objects.select_related('category').order_by('pk'))
+    Payee.objects.bulk_create(Payee(name=payee_name(rng, i), alias=alias_list[i // 2]) for i in range(payees))
+
+    account_list = list(Account.objects.order_by('pk'))
+    transactions = []
+    month = LEDGER_START
+    for i in range(years * 12):
+        days = (modules.add_months(month, 1) - month).days
+        for j in range(per_month):
+            alias = rng.choice(alias_list)
+            cents = rng.randrange(100, 20000)
+            if alias.category.type == Category.INCOME:
+                cents *= 10
+            else:
+                cents = -cents
+            transactions.append(Transaction(date=month + datetime.timedelta(days=rng.randrange(days)), alias=alias,
+                                            amount=Money.from_cents(cents), account=rng.choice(account_list)))
+        month = modules.add_months(month, 1)
+    Transaction.objects.bulk_create(transactions, batch_size=500)
+
+    # bulk_create skips the signals that keep these up to date
+    Parameters.objects.update_or_create(pk=1, defaults={'date': month - datetime.timedelta(days=1)})
+    modules.rebuild_rollups()
+    modules.clear_payee_cache()
+    return len(transactions)
+
+
+def generate_statement(lines=500, new_payees=0.05, seed=0):
+    # statement for the month after the ledger, with a share of payees that are not known yet
+    rng = random.Random(seed)
+    start = modules.add_months(Transaction.objects.latest('date').date, 1).replace(day=1)
+    payee_list = list(Payee.objects.order_by('pk').values_list('name', flat=True))
+    rows = ['Date\t Description\t Value']
+    for i in range(lines):
+        name = payee_name(rng, len(payee_list) + i) if rng.random() < new_payees else rng.choice(payee_list)
+        date = start + datetime.timedelta(days=rng.randrange(28))
+        rows.append('{:%d/%m/%Y}\t{}\t{}'.format(date, name, Money.from_cents(rng.randrange(100, 20000))))
+    return '\n'.join(rows).encode()
+
+
+def rolled_back(function):
+    # writing benchmarks leave the ledger as they found it so every run does the same work
+    def run():
+        with db_transaction.atomic():
+            function()
+            db_transaction.set_rollback(True)
+    return run
+
+
+def get_view(client, name, *args):
+    def run():
+        response = client.get(reverse('accounts:' + name, args=args))
+        if response.status_code != 200:
+            raise AssertionError('{} returned {}'.format(name, response.status_code))
+    return run
+
+
+def get_benchmarks(statement):
+    client = Client()
+    account = Account.objects.order_by('pk').first()
+    category = Category.objects.filter(type=Category.EXPENSE).order_by('pk').first()
+    subcategory = Subcategory.objects.filter(category=category).order_by('pk').first()
+    alias = Alias.objects.filter(category=category).order_by('pk').first()
+    staged = [StagedLine(date=date, payee=payee, amount=amount) for date, payee, amount in modules.iter_statement(ContentFile(statement))]
+
+    def save_statement():
+        statement_import = modules.stage_statement(ContentFile(statement), account)
+        modules.resolve_import(statement_import)
+        modules.save_import(statement_import)
+
+    benchmarks = [
+        ('view:index', get_view(client, 'index')),
+        ('view:history', get_view(client, 'history')),
+        ('view:trend', get_view(client, 'trend')),
+    ]
+    for name, pk in [('account', account.pk), ('category', category.pk), ('subcategory', subcategory.pk), ('alias', alias.pk)]:
+        benchmarks.append(('view:{}_transactions'.format(name), get_view(client, name + '_transactions', pk)))
+        benchmarks.append(('view:{}_history'.format(name), get_view(client, name + '_history', pk)))
+    benchmarks += [
+        ('import:read_statement', lambda: sum(1 for line in modules.iter_statement(ContentFile(statement)))),
+        ('import:stage_statement', rolled_back(lambda: modules.stage_statement(ContentFile(statement), account))),
+        ('import:assign_alias', lambda: modules.assign_alias(staged)),
+        ('import:save_statement', rolled_back(save_statement)),
+    ]
+    return benchmarks
+
+
+def count_queries(function):
+    # counted with a wrapper as the query log is reset at the start of every request
+    queries = []
+
+    def record(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+    with connection.execute_wrapper(record):
+        function()
+    return len(queries)
+
+
+def measure(function, repeat):
+    # one untimed warm up, one run counting queries, then the timed runs
+    function()
+    queries = count_queries(function)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'queries': queries,
+        'min_ms': round(min(times), 3),
+        'median_ms': round(statistics.median(times), 3),
+        'mean_ms': round(statistics.mean(times), 3),
+        'repeat': repeat,
+    }
+
+
+def run_benchmarks(statement, repeat=5, only=None):
+    # the page cache would turn every view into a cache hit after the warm up
+    results = {}
+    with override_settings(ACCOUNTS_PAGE_CACHE_SECONDS=0):
+        for name, function in get_benchmarks(statement):
+            if only and only not in name:
+                continue
+            results[name] = measure(function, repeat)
+    return results
+
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'vectorized_analytics': bool(settings.ACCOUNTS_VECTORIZED_ANALYTICS),
+    }
+
+
+def compare(results, baseline, threshold=0.2):
+    # a benchmark regresses when its median slows by more than threshold or it runs more queries
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('benchmarks', {}).get(name)
+        if base is None:
+            continue
+        if result['median_ms'] > base['median_ms'] * (1 + threshold):
+            regressions.append('{}: median {:.1f} ms, baseline {:.1f} ms'.format(name, result['median_ms'], base['median_ms']))
+        if result['queries'] > base['queries']:
+            regressions.append('{}: {} queries, baseline {}'.format(name, result['queries'], base['queries']))
+    return regressions
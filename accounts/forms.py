@@ -1,4 +1,5 @@
 from django import forms
+from . import modules
 from .models import Alias, DoubleEntry, Payee, Transaction
 
 
@@ -37,4 +38,18 @@ class DateInput(forms.DateInput):
 class DateForm(forms.Form):
     date = forms.DateField(widget=DateInput)
 
-    
\ No newline at end of file
+
+class TrendForm(forms.Form):
+    start = forms.DateField(widget=DateInput)
+    end = forms.DateField(widget=DateInput)
+    format = forms.ChoiceField(choices=[('html', 'Page'), ('csv', 'CSV'), ('json', 'JSON')], required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if start and end:
+            if start > end:
+                raise forms.ValidationError('The start date must be before the end date')
+            if modules.months_between(start, end) > modules.TREND_MAX_MONTHS:
+                raise forms.ValidationError('The trend covers at most {} months'.format(modules.TREND_MAX_MONTHS))
+        return cleaned_data
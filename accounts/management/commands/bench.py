@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+import json
+
+from accounts import bench
+
+
+class Command(BaseCommand):
+    help = 'Time the reporting views and statement imports against a synthetic ledger in a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=3)
+        parser.add_argument('--categories', type=int, default=6)
+        parser.add_argument('--subcategories', type=int, default=3, help='Subcategories in each category')
+        parser.add_argument('--payees', type=int, default=300)
+        parser.add_argument('--years', type=int, default=2)
+        parser.add_argument('--per-month', type=int, default=200, help='Transactions in each month')
+        parser.add_argument('--statement-lines', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each benchmark')
+        parser.add_argument('--filter', help='Only run the benchmarks whose name contains this')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='Baseline JSON file, regressions make the command fail')
+        parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown of the median allowed against the baseline')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError('Could not read the baseline {}: {}'.format(options['compare'], e))
+
+        params = {name: options[name] for name in [
+            'accounts', 'categories', 'subcategories', 'payees', 'years', 'per_month', 'statement_lines', 'seed',
+        ]}
+        # the ledger is generated in a test database so the real one is never touched
+        database_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            transactions = bench.generate_ledger(
+                accounts=params['accounts'], categories=params['categories'], subcategories=params['subcategories'],
+                payees=params['payees'], years=params['years'], per_month=params['per_month'], seed=params['seed'],
+            )
+            statement = bench.generate_statement(lines=params['statement_lines'], seed=params['seed'])
+            self.stdout.write('{} transactions generated'.format(transactions))
+            results = bench.run_benchmarks(statement, repeat=options['repeat'], only=options['filter'])
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results.items():
+            line = '{:<32} {:>10.2f} ms {:>5} queries'.format(name, result['median_ms'], result['queries'])
+            base = baseline and baseline.get('benchmarks', {}).get(name)
+            if base:
+                line += '  {:+.0%}'.format(result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] else 0)
+            self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'params': params, 'environment': bench.get_environment(), 'benchmarks': results}, f, indent=2)
+
+        if baseline is not None:
+            if baseline.get('params') != params:
+                self.stderr.write('The baseline was run with different parameters: {}'.format(baseline.get('params')))
+            regressions = bench.compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Regressions against {}:\n{}'.format(options['compare'], '\n'.join(regressions)))
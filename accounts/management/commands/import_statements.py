@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+
+from accounts import modules
+from accounts.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Import every statement in a directory, each file named after its account'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--account', help='Import every file into this account instead')
+        parser.add_argument('--workers', type=int, help='Processes parsing the files, one per CPU by default')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError('{} is not a directory'.format(directory))
+        accounts = {account.name.lower(): account for account in Account.objects.all()}
+        if options['account'] and options['account'].lower() not in accounts:
+            raise CommandError('There is no account {}'.format(options['account']))
+
+        statements = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            account = accounts.get((options['account'] or os.path.splitext(name)[0]).lower())
+            if account is None:
+                self.stderr.write('{}: no account named {}'.format(name, os.path.splitext(name)[0]))
+                continue
+            statements.append((path, account))
+
+        results = modules.import_statements(statements, options['workers'])
+        for (path, account), result in zip(statements, results):
+            name = os.path.basename(path)
+            if result['error']:
+                self.stderr.write('{}: {}'.format(name, result['error']))
+            elif result['new_payees']:
+                self.stderr.write('{}: new payees {}'.format(name, ', '.join(result['new_payees'])))
+            else:
+                self.stdout.write('{}: {} transactions saved into {}'.format(name, result['saved'], account))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+import time
+import traceback
+
+from accounts import modules
+
+
+class Command(BaseCommand):
+    help = 'Run the queued statement imports, polling for new ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls of an empty queue')
+        parser.add_argument('--workers', type=int, help='Processes parsing multi-file imports, one per CPU by default')
+
+    def handle(self, *args, **options):
+        while True:
+            modules.run_import_jobs(options['workers'], self.report)
+            if options['once']:
+                return
+            time.sleep(options['interval'])
+
+    def report(self, jobs, error):
+        if error:
+            self.stderr.write(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+        for job in jobs:
+            self.stdout.write('{}: {} of {} lines'.format(job, job.lines, job.total))
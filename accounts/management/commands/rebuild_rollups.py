@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from accounts import modules
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the monthly rollup table from the transactions'
+
+    def handle(self, *args, **options):
+        count = modules.rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS('{} monthly rollups rebuilt'.format(count)))
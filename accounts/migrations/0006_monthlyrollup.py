@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions
+
+
+def build_rollups(apps, schema_editor):
+    Transaction = apps.get_model('accounts', 'Transaction')
+    MonthlyRollup = apps.get_model('accounts', 'MonthlyRollup')
+    rows = Transaction.objects.annotate(
+        year=models.functions.ExtractYear('date'), month=models.functions.ExtractMonth('date')
+    ).values('year', 'month', 'account', 'alias').annotate(
+        total=models.Sum('amount'), count=models.Count('id')).order_by()
+    MonthlyRollup.objects.bulk_create(
+        MonthlyRollup(year=row['year'], month=row['month'], account_id=row['account'], alias_id=row['alias'],
+                      total=row['total'], count=row['count'])
+        for row in rows
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_auto_20211126_1736'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('month', models.PositiveSmallIntegerField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounts.account')),
+                ('alias', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounts.alias')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='monthlyrollup',
+            constraint=models.UniqueConstraint(fields=('year', 'month', 'account', 'alias'), name='unique_monthly_rollup'),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:52
+
+from collections import Counter
+from decimal import Decimal
+import hashlib
+
+from django.db import migrations, models
+
+
+def add_digests(apps, schema_editor):
+    # same key and occurrence numbering as modules.transaction_digest
+    Transaction = apps.get_model('accounts', 'Transaction')
+    seen = Counter()
+    transactions = []
+    for transaction in Transaction.objects.order_by('id'):
+        key = (transaction.account_id, transaction.date, transaction.alias_id, Decimal(transaction.amount).quantize(Decimal('0.01')))
+        transaction.digest = hashlib.sha1('{}|{}|{}|{}|{}'.format(*key, seen[key]).encode()).hexdigest()
+        seen[key] += 1
+        transactions.append(transaction)
+    Transaction.objects.bulk_update(transactions, ['digest'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_transaction_date_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='digest',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True, unique=True),
+        ),
+        migrations.RunPython(add_digests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_import_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='importjob',
+            name='kind',
+            field=models.CharField(choices=[('stage', 'Stage statement'), ('save', 'Save transactions'), ('import', 'Import statement')], max_length=6),
+        ),
+    ]
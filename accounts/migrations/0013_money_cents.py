@@ -0,0 +1,131 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:14
+
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F
+from django.db.models.functions import Cast, Round
+import accounts.models
+
+
+# amounts move from decimal columns to integer cents, each through a temporary <name>_cents column
+MONEY_FIELDS = [
+    ('Account', 'initial_balance'),
+    ('Transaction', 'amount'),
+    ('MonthlyRollup', 'total'),
+    ('StagedLine', 'amount'),
+]
+
+
+def to_cents(apps, schema_editor):
+    for model_name, name in MONEY_FIELDS:
+        model = apps.get_model('accounts', model_name)
+        cents = Cast(Round(ExpressionWrapper(F(name) * 100, output_field=models.DecimalField())), models.BigIntegerField())
+        model.objects.update(**{name + '_cents': cents})
+
+
+def to_decimal(apps, schema_editor):
+    for model_name, name in MONEY_FIELDS:
+        model = apps.get_model('accounts', model_name)
+        rows = list(model.objects.only(name + '_cents'))
+        for row in rows:
+            setattr(row, name, getattr(row, name + '_cents'))
+        model.objects.bulk_update(rows, [name], batch_size=500)
+
+
+def clear_checkpoints(apps, schema_editor):
+    # checkpoints are rebuilt from the rollups on the next read
+    apps.get_model('accounts', 'BalanceCheckpoint').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_import_job_batches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='initial_balance_cents',
+            field=accounts.models.MoneyField(default=0),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='amount_cents',
+            field=accounts.models.MoneyField(default=0),
+        ),
+        migrations.AddField(
+            model_name='monthlyrollup',
+            name='total_cents',
+            field=accounts.models.MoneyField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stagedline',
+            name='amount_cents',
+            field=accounts.models.MoneyField(default=0),
+        ),
+        migrations.RunPython(to_cents, to_decimal),
+        # defaults let the decimal columns be added back to existing rows when migrating backwards
+        migrations.AlterField(
+            model_name='transaction',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=8),
+        ),
+        migrations.AlterField(
+            model_name='stagedline',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RemoveField(
+            model_name='account',
+            name='initial_balance',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='amount',
+        ),
+        migrations.RemoveField(
+            model_name='monthlyrollup',
+            name='total',
+        ),
+        migrations.RemoveField(
+            model_name='stagedline',
+            name='amount',
+        ),
+        migrations.RenameField(
+            model_name='account',
+            old_name='initial_balance_cents',
+            new_name='initial_balance',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='amount_cents',
+            new_name='amount',
+        ),
+        migrations.RenameField(
+            model_name='monthlyrollup',
+            old_name='total_cents',
+            new_name='total',
+        ),
+        migrations.RenameField(
+            model_name='stagedline',
+            old_name='amount_cents',
+            new_name='amount',
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='amount',
+            field=accounts.models.MoneyField(),
+        ),
+        migrations.AlterField(
+            model_name='stagedline',
+            name='amount',
+            field=accounts.models.MoneyField(),
+        ),
+        migrations.RunPython(clear_checkpoints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='balancecheckpoint',
+            name='balance',
+            field=accounts.models.MoneyField(),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, clear_checkpoints),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:44
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_updated(apps, schema_editor):
+    # jobs already running are judged from their start
+    ImportJob = apps.get_model('accounts', 'ImportJob')
+    ImportJob.objects.update(updated=F('started'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_ledger_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='updated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_updated, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,49 @@
+from django import forms
+from django.core.exceptions import ValidationError
 from django.db import models
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+
+class Money(Decimal):
+    # an amount in major units, always with two decimal places
+    def __new__(cls, value='0'):
+        if isinstance(value, float):
+            value = str(value)
+        return super().__new__(cls, Decimal(value).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+
+    @classmethod
+    def from_cents(cls, cents):
+        return cls(Decimal(cents).scaleb(-2))
+
+    @property
+    def cents(self):
+        return int(self.scaleb(2))
+
+
+class MoneyField(models.BigIntegerField):
+    # stored as integer cents so sums stay exact integer arithmetic in the database
+    description = 'Amount of money stored in cents'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return Money.from_cents(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Money):
+            return value
+        try:
+            return Money(value)
+        except (InvalidOperation, TypeError, ValueError):
+            raise ValidationError(self.error_messages['invalid'], code='invalid', params={'value': value})
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return self.to_python(value).cents
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{'form_class': forms.DecimalField, 'decimal_places': 2, **kwargs})
 
 
 class Account(models.Model):
@@ -10,7 +55,7 @@ class Account(models.Model):
         (LIABILITY, 'Liability'),
     ]
     type = models.CharField(max_length=1, choices=ACCOUNT_TYPE_CHOICES, default=ASSET)
-    initial_balance = models.DecimalField(max_digits=8, decimal_places=2, default=0)
+    initial_balance = MoneyField(default=0)
 
     def __str__(self):
         return self.name
@@ -59,12 +104,20 @@ class Alias(models.Model):
 class Transaction(models.Model):
     date = models.DateField()
     alias = models.ForeignKey(Alias, on_delete=models.CASCADE)
-    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    amount = MoneyField()
     account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    # content hash set by statement imports, makes re-imports idempotent
+    digest = models.CharField(max_length=40, unique=True, null=True, blank=True, editable=False)
     
     def __str__(self):
         return '{} {} {} {}'.format(self.account, self.date, self.alias, self.amount)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'date'], name='transaction_account_date'),
+            models.Index(fields=['alias', 'date'], name='transaction_alias_date'),
+        ]
+
 
 class Payee(models.Model):
     name = models.CharField(max_length=50)
@@ -82,3 +135,107 @@ class DoubleEntry(models.Model):
 
 class Parameters(models.Model):
     date = models.DateField()
+
+
+class LedgerVersion(models.Model):
+    # single row bumped inside every ledger write, shared by every process serving or importing
+    version = models.BigIntegerField(default=0)
+
+
+class MonthlyRollup(models.Model):
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    alias = models.ForeignKey(Alias, on_delete=models.CASCADE)
+    total = MoneyField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '{}-{:02d} {} {} {}'.format(self.year, self.month, self.account, self.alias.name, self.total)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['year', 'month', 'account', 'alias'], name='unique_monthly_rollup'),
+        ]
+
+
+class BalanceCheckpoint(models.Model):
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    date = models.DateField()
+    balance = MoneyField()
+
+    def __str__(self):
+        return '{} {} {}'.format(self.account, self.date, self.balance)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'date'], name='unique_balance_checkpoint'),
+        ]
+
+
+class StatementImport(models.Model):
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    # the uploaded file, kept until the import worker has staged it
+    statement = models.FileField(upload_to='statements/', blank=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.account, self.created)
+
+
+class StagedLine(models.Model):
+    statement_import = models.ForeignKey(StatementImport, on_delete=models.CASCADE)
+    date = models.DateField()
+    payee = models.CharField(max_length=100)
+    amount = MoneyField()
+    alias = models.ForeignKey(Alias, on_delete=models.SET_NULL, null=True, blank=True)
+    duplicate = models.BooleanField(default=False)
+
+    def __str__(self):
+        return ' '.join(str(field) for field in self.fields)
+
+    @property
+    def fields(self):
+        # account, date, alias or payee, category, subcategory and amount as shown by the upload pages
+        if not self.alias:
+            return [self.statement_import.account.name, self.date.strftime('%d/%m/%Y'), self.payee, 'New', '', self.amount]
+        category = self.alias.category.name if self.alias.category else ''
+        subcategory = self.alias.subcategory.name if self.alias.subcategory else ''
+        return [self.statement_import.account.name, self.date.strftime('%d/%m/%Y'), self.alias.name, category, subcategory, self.amount]
+
+
+class ImportJob(models.Model):
+    STAGE = 'stage'
+    SAVE = 'save'
+    IMPORT = 'import'
+    KIND_CHOICES = [(STAGE, 'Stage statement'), (SAVE, 'Save transactions'), (IMPORT, 'Import statement')]
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    # a saved import is deleted, the job stays behind to report it
+    statement_import = models.ForeignKey(StatementImport, on_delete=models.SET_NULL, null=True, blank=True)
+    kind = models.CharField(max_length=6, choices=KIND_CHOICES)
+    name = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=QUEUED)
+    lines = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    # last progress write of a running job, stale when its worker stopped
+    updated = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'id'], name='importjob_status_id')]
+
+    def __str__(self):
+        return '{} {} {}'.format(self.get_kind_display(), self.statement_import_id, self.get_status_display())
+
+    @property
+    def finished_running(self):
+        return self.status in (self.DONE, self.FAILED)
+
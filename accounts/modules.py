@@ -1,123 +1,949 @@
-from django.db.models import Sum
-from .models import Payee, Account, Transaction, Category, Subcategory
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.db import transaction as db_transaction
+from django.db.models import Case, Count, F, Max, Min, OuterRef, Q, Subquery, Sum, When
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+import calendar
+import codecs
+import csv
+import datetime
+import django
+import hashlib
+import heapq
+import itertools
+import os
+import re
+import time
 
+from .models import Money, MoneyField, Payee, Account, Transaction, Category, Subcategory, Alias, DoubleEntry, MonthlyRollup, BalanceCheckpoint, StatementImport, StagedLine, ImportJob, LedgerVersion
+
+
+def to_date(value):
+    # transactions built from statements may still carry iso strings
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+ROLLUP_BATCH_SIZE = 500
+
+
+def update_rollups(transactions, sign=1):
+    deltas = {}
+    for transaction in transactions:
+        date = to_date(transaction.date)
+        key = (date.year, date.month, transaction.account_id, transaction.alias_id)
+        cents, count = deltas.get(key, (0, 0))
+        deltas[key] = (cents + sign * Money(transaction.amount).cents, count + sign)
+
+    if not deltas:
+        return
+    with db_transaction.atomic():
+        # the existing rows of every key in a few queries, matched up in python
+        existing = {}
+        account_ids = {key[2] for key in deltas}
+        years = {key[0] for key in deltas}
+        alias_ids = sorted({key[3] for key in deltas})
+        for i in range(0, len(alias_ids), ROLLUP_BATCH_SIZE):
+            rollups = MonthlyRollup.objects.filter(
+                alias_id__in=alias_ids[i:i + ROLLUP_BATCH_SIZE], account_id__in=account_ids, year__in=years).only('pk', 'year', 'month', 'account', 'alias')
+            for rollup in rollups:
+                existing[(rollup.year, rollup.month, rollup.account_id, rollup.alias_id)] = rollup
+
+        updated, created, emptied = [], [], []
+        for key, (cents, count) in deltas.items():
+            rollup = existing.get(key)
+            if rollup:
+                # increments rather than totals so concurrent writers do not overwrite each other,
+                # the total column holds cents and the delta is added as a plain integer
+                rollup.total = F('total') + cents
+                rollup.count = F('count') + count
+                updated.append(rollup)
+                if count < 0:
+                    emptied.append(rollup.pk)
+            elif count > 0:
+                year, month, account_id, alias_id = key
+                created.append(MonthlyRollup(year=year, month=month, account_id=account_id, alias_id=alias_id,
+                                             total=Money.from_cents(cents), count=count))
+        MonthlyRollup.objects.bulk_update(updated, ['total', 'count'])
+        # months left without transactions are dropped, as a rebuild would not have them
+        for i in range(0, len(emptied), ROLLUP_BATCH_SIZE):
+            MonthlyRollup.objects.filter(pk__in=emptied[i:i + ROLLUP_BATCH_SIZE], count=0).delete()
+        MonthlyRollup.objects.bulk_create(created)
+
+
+def rebuild_rollups():
+    rows = Transaction.objects.annotate(year=ExtractYear('date'), month=ExtractMonth('date')).values(
+        'year', 'month', 'account', 'alias').annotate(total=Sum('amount'), count=Count('id')).order_by()
+    with db_transaction.atomic():
+        ledger_changed()
+        MonthlyRollup.objects.all().delete()
+        MonthlyRollup.objects.bulk_create(
+            MonthlyRollup(year=row['year'], month=row['month'], account_id=row['account'], alias_id=row['alias'],
+                          total=row['total'], count=row['count'])
+            for row in rows
+        )
+    return MonthlyRollup.objects.count()
+
+
+def through_month(balance_date):
+    # rollup rows for balance_date's month and every month before it
+    return Q(year__lt=balance_date.year) | Q(year=balance_date.year, month__lte=balance_date.month)
+
+
+def month_end(balance_date):
+    # checkpoint covering every month before balance_date's month
+    return balance_date.replace(day=1) - datetime.timedelta(days=1)
+
+
+def month_range(balance_date):
+    # first and last day of balance_date's month, usable by the (account, date) and (alias, date) indexes
+    last_day = calendar.monthrange(balance_date.year, balance_date.month)[1]
+    return balance_date.replace(day=1), balance_date.replace(day=last_day)
+
+
+def invalidate_checkpoints(account_id, date):
+    BalanceCheckpoint.objects.filter(account_id=account_id, date__gte=to_date(date)).delete()
+
+
+def get_checkpoints(checkpoint_dates, account_list):
+    account_ids = [account.pk for account in account_list]
+    checkpoints = {
+        (checkpoint['account'], checkpoint['date']): checkpoint['balance'] for checkpoint in
+        BalanceCheckpoint.objects.filter(date__in=checkpoint_dates, account__in=account_ids).values('account', 'date', 'balance')
+    }
+    missing_dates = [
+        checkpoint_date for checkpoint_date in sorted(set(checkpoint_dates))
+        if any((account.pk, checkpoint_date) not in checkpoints for account in account_list)
+    ]
+    if not missing_dates:
+        return checkpoints
+
+    # computed and stored under the ledger lock, a writer either commits before the rollups
+    # are read here or invalidates the new checkpoints after they are stored
+    with db_transaction.atomic():
+        lock_ledger()
+        for checkpoint_date in missing_dates:
+            missing = [account for account in account_list if (account.pk, checkpoint_date) not in checkpoints]
+
+            # start every missing account from its nearest earlier checkpoint
+            previous = BalanceCheckpoint.objects.filter(account=OuterRef('pk'), date__lt=checkpoint_date).order_by('-date')
+            starts = {
+                row['pk']: row for row in
+                Account.objects.filter(pk__in=[account.pk for account in missing]).annotate(
+                    last_date=Subquery(previous.values('date')[:1]),
+                    last_balance=Subquery(previous.values('balance')[:1]),
+                ).values('pk', 'initial_balance', 'last_date', 'last_balance')
+            }
+
+            # then add the monthly rollups between that checkpoint and this one
+            rollups = MonthlyRollup.objects.filter(through_month(checkpoint_date), account__in=starts)
+            last_dates = [row['last_date'] for row in starts.values() if row['last_date']]
+            if len(last_dates) == len(starts):
+                rollups = rollups.exclude(through_month(min(last_dates)))
+            account_rows = {}
+            for row in rollups.values('account', 'year', 'month').annotate(total=Sum('total')).order_by():
+                account_rows.setdefault(row['account'], []).append(row)
+
+            new_checkpoints = []
+            for account in missing:
+                start = starts[account.pk]
+                # the initial balance as read under the lock, not as the caller loaded it
+                balance = start['initial_balance']
+                if start['last_date']:
+                    balance = start['last_balance']
+                for row in account_rows.get(account.pk, []):
+                    if start['last_date'] and (row['year'], row['month']) <= (start['last_date'].year, start['last_date'].month):
+                        continue
+                    balance += row['total']
+                checkpoints[(account.pk, checkpoint_date)] = balance
+                new_checkpoints.append(BalanceCheckpoint(account=account, date=checkpoint_date, balance=balance))
+            BalanceCheckpoint.objects.bulk_create(new_checkpoints, ignore_conflicts=True)
+    return checkpoints
 
 
 def sum_account(account, balance_date):
-    total = account.initial_balance 
-    result = Transaction.objects.filter(account=account, date__lte=balance_date).aggregate(Sum('amount'))
+    checkpoint_date = month_end(balance_date)
+    total = get_checkpoints([checkpoint_date], [account])[(account.pk, checkpoint_date)]
+    # only the current month is read from raw transactions
+    result = Transaction.objects.filter(
+        account=account, date__gte=balance_date.replace(day=1), date__lte=balance_date).aggregate(Sum('amount'))
     if result['amount__sum']:
         total += result['amount__sum']
     return total
 
 
-def add_account_totals(balance_date):
-    account_list = Account.objects.all()
+def month_sum(balance_date):
+    # the open month of one account, the date window is in the WHERE clause for the (account, date) index
+    transactions = Transaction.objects.filter(account=OuterRef('pk'), date__gte=balance_date.replace(day=1), date__lte=balance_date)
+    return Subquery(transactions.values('account').annotate(total=Sum('amount')).values('total'))
+
+
+def add_account_totals(*balance_dates):
+    # closed months come from the month-end checkpoints and the open month from
+    # raw transactions, with one correlated sum per date in a single query
+    sums = {'sum_{}'.format(i): month_sum(balance_date) for i, balance_date in enumerate(balance_dates)}
+    account_list = Account.objects.annotate(**sums).order_by('pk')
+    checkpoints = get_checkpoints([month_end(balance_date) for balance_date in balance_dates], list(account_list))
     for account in account_list:
-        account.total = sum_account(account, balance_date)
+        account.totals = []
+        for i, balance_date in enumerate(balance_dates):
+            total = checkpoints[(account.pk, month_end(balance_date))]
+            result = getattr(account, 'sum_{}'.format(i))
+            if result:
+                total += result
+            account.totals.append(total)
+        # account.total keeps the balance at the first date
+        account.total = account.totals[0]
     return account_list
 
 
-def get_balance_summary(account_list):
+def get_balance_summary(account_list, index=0):
     assets, liabilities = 0, 0
     for account in account_list:
         if account.type == 'A':
-            assets += account.total
+            assets += account.totals[index]
         if account.type == 'L':
-            liabilities += account.total
+            liabilities += account.totals[index]
     return assets, liabilities
 
 
+# the ledger version lives in the database so the web and worker processes agree on it,
+# the latest transaction date is cached under it in each process
+LEDGER_HEAD_KEY = 'accounts:ledger_head:{}'
+
+
+def get_ledger_version():
+    version = LedgerVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+    if version is None:
+        # start from the clock so a reset database never goes back to a version already cached
+        version = LedgerVersion.objects.get_or_create(pk=1, defaults={'version': time.time_ns()})[0].version
+    return version
+
+
+def update_ledger_version(version):
+    if not LedgerVersion.objects.filter(pk=1).update(version=version):
+        get_ledger_version()
+        LedgerVersion.objects.filter(pk=1).update(version=version)
+
+
+def ledger_changed():
+    # updated in the writing transaction, readers see the new version when the data commits.
+    # writers call it before touching rollups or checkpoints so it also takes the ledger lock first
+    update_ledger_version(F('version') + 1)
+
+
+def lock_ledger():
+    # a write that changes nothing, the ledger row stays locked until the transaction ends
+    update_ledger_version(F('version'))
+
+
+def get_ledger_head():
+    version = get_ledger_version()
+    key = LEDGER_HEAD_KEY.format(version)
+    head = cache.get(key)
+    if head is None:
+        latest = Transaction.objects.aggregate(date=Max('date'))['date']
+        head = {'date': latest or datetime.date.today(), 'version': version}
+        cache.set(key, head, None)
+    return head
+
+
+def signed_amount(field='amount'):
+    # expenses paid from an asset account are reported as positive totals
+    return Case(
+        When(alias__category__type='E', account__type='A', then=-F(field)),
+        default=F(field),
+        output_field=MoneyField(),
+    )
+
+
+def sum_rollups(rollups):
+    result = rollups.aggregate(total=Sum(signed_amount('total')))
+    return result['total'] or 0
+
+
+def month_rollups(balance_date):
+    return MonthlyRollup.objects.filter(year=balance_date.year, month=balance_date.month)
+
+
 def sum_category(category, balance_date):
-    q = Account.objects.filter(transaction__alias__category=category, transaction__date__month=balance_date.month).annotate(total=Sum('transaction__amount'))
-    total = 0
-    if q:
-        for account in q:
-            if category.type == 'E' and account.type == 'A':
-                account.total = -account.total
-            total += account.total
-    return total
+    return sum_rollups(month_rollups(balance_date).filter(alias__category=category))
 
 
-def get_expenses_report(balance_date):
+def sum_subcategory(subcategory, balance_date):
+    return sum_rollups(month_rollups(balance_date).filter(alias__subcategory=subcategory))
+
+
+def sum_alias(alias, balance_date):
+    return sum_rollups(month_rollups(balance_date).filter(alias=alias))
+
+
+def get_report(balance_date):
+    # category -> subcategory -> alias totals from a single grouped query over the month rollups
+    rows = month_rollups(balance_date).filter(alias__category__isnull=False).values(
+        'alias', 'alias__name',
+        'alias__category', 'alias__category__name', 'alias__category__type',
+        'alias__subcategory', 'alias__subcategory__name',
+    ).annotate(total=Sum(signed_amount('total'))).order_by('alias__category', 'alias__subcategory', 'alias')
+
+    categories, subcategories = {}, {}
+    for row in rows:
+        category = categories.get(row['alias__category'])
+        if category is None:
+            category = Category(pk=row['alias__category'], name=row['alias__category__name'], type=row['alias__category__type'])
+            category.total = 0
+            category.subcategories = []
+            category.aliases = []
+            categories[category.pk] = category
+        category.total += row['total']
+
+        subcategory = None
+        if row['alias__subcategory'] is not None:
+            subcategory = subcategories.get(row['alias__subcategory'])
+            if subcategory is None:
+                subcategory = Subcategory(pk=row['alias__subcategory'], name=row['alias__subcategory__name'], category=category)
+                subcategory.total = 0
+                subcategory.aliases = []
+                subcategories[subcategory.pk] = subcategory
+                category.subcategories.append(subcategory)
+            subcategory.total += row['total']
+
+        alias = Alias(pk=row['alias'], name=row['alias__name'], category=category, subcategory=subcategory)
+        alias.total = row['total']
+        if alias.total != 0:
+            category.aliases.append(alias)
+            if subcategory:
+                subcategory.aliases.append(alias)
+
+    # drop empty totals as the per-category helpers did
     category_list = []
-    income, expenses = 0, 0
-    for category in Category.objects.all():
-        category.total = sum_category(category, balance_date)
+    for category in categories.values():
+        category.subcategories = [subcategory for subcategory in category.subcategories if subcategory.total != 0]
         if category.total != 0:
             category_list.append(category)
-            if category.type == 'I':
-                income += category.total
-            if category.type == 'E':
-                expenses += category.total
-    return category_list, income, expenses
+    return category_list
 
 
-def sum_subcategory(subcategory, balance_date):
-    q = Account.objects.filter(transaction__alias__subcategory=subcategory, transaction__date__month=balance_date.month).annotate(total=Sum('transaction__amount'))
-    total = 0
-    if q:
-        for account in q:
-            if subcategory.category.type == 'E' and account.type == 'A':
-                account.total = -account.total
-            total += account.total
-    return total
+def get_report_summary(category_list):
+    income, expenses = 0, 0
+    for category in category_list:
+        if category.type == 'I':
+            income += category.total
+        if category.type == 'E':
+            expenses += category.total
+    return income, expenses
+
+
+def get_subcategory_list(category_list):
+    return [subcategory for category in category_list for subcategory in category.subcategories]
+
+
+def get_expenses_report(balance_date):
+    category_list = get_report(balance_date)
+    income, expenses = get_report_summary(category_list)
+    return category_list, income, expenses
 
 
 def add_subcategory_totals(balance_date):
-    subcategory_list = []
-    for subcategory in Subcategory.objects.all():
-        subcategory.total = sum_subcategory(subcategory, balance_date)
-        if subcategory.total != 0:
-            subcategory_list.append(subcategory)
-    return subcategory_list
+    return get_subcategory_list(get_report(balance_date))
 
 
-def sum_alias(alias, balance_date):
-    q = Account.objects.filter(transaction__alias=alias, transaction__date__month=balance_date.month).annotate(total=Sum('transaction__amount'))
-    total = 0
-    if q:
-        for account in q:
-            if alias.category and alias.category.type == 'E' and account.type == 'A':
-                account.total = -account.total
-            total += account.total
-    return total
+# longest range the trend report accepts, ten years of months
+TREND_MAX_MONTHS = 120
+
+
+def add_months(balance_date, months):
+    index = balance_date.year * 12 + balance_date.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def iter_months(start, end):
+    month = datetime.date(start.year, start.month, 1)
+    while month <= end:
+        yield month
+        month = add_months(month, 1)
+
+
+def months_between(start, end):
+    return (end.year - start.year) * 12 + end.month - start.month + 1
+
+
+def get_trend(start, end):
+    # per-category and per-account monthly totals from one grouped query over the rollups
+    after_start = Q(year__gt=start.year) | Q(year=start.year, month__gte=start.month)
+    before_end = Q(year__lt=end.year) | Q(year=end.year, month__lte=end.month)
+    # rows emptied before update_rollups dropped them would add months the numpy engine never sees
+    rows = MonthlyRollup.objects.filter(after_start & before_end, count__gt=0).values(
+        'year', 'month', 'account', 'account__name', 'alias__category', 'alias__category__name',
+    ).annotate(movement=Sum('total'), signed=Sum(signed_amount('total'))).order_by()
+
+    # grouped by id so categories or accounts sharing a name are kept apart
+    months = list(iter_months(start, end))
+    columns = {(month.year, month.month): i for i, month in enumerate(months)}
+    categories, accounts = {}, {}
+    for row in rows:
+        column = columns[(row['year'], row['month'])]
+        if row['alias__category'] is not None:
+            category = categories.setdefault(row['alias__category'], {'id': row['alias__category'], 'name': row['alias__category__name'], 'totals': [Decimal(0)] * len(months)})
+            category['totals'][column] += row['signed']
+        account = accounts.setdefault(row['account'], {'id': row['account'], 'name': row['account__name'], 'totals': [Decimal(0)] * len(months)})
+        account['totals'][column] += row['movement']
+    cents = Decimal('0.01')
+    for row in itertools.chain(categories.values(), accounts.values()):
+        row['totals'] = [total.quantize(cents) for total in row['totals']]
+    return {
+        'months': ['{:%Y-%m}'.format(month) for month in months],
+        'categories': sorted(categories.values(), key=lambda row: (row['name'], row['id'])),
+        'accounts': sorted(accounts.values(), key=lambda row: (row['name'], row['id'])),
+    }
+
+
+def trend_rows(trend):
+    # one row per category and account, one column per month
+    yield ['Type', 'Name'] + trend['months']
+    for row_type, key in [('Category', 'categories'), ('Account', 'accounts')]:
+        for row in trend[key]:
+            yield [row_type, row['name']] + ['{:.2f}'.format(total) for total in row['totals']]
+
+
+def iter_lines(chunks):
+    # decode chunk by chunk and yield whole lines, a line may span two chunks
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(keepends=True)
+        pending = ''
+        if lines and not lines[-1].endswith(('\n', '\r')):
+            pending = lines.pop()
+        for line in lines:
+            yield line
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
 
+# decimal separator of exports whose delimiter tells it, commas inside comma separated amounts are thousands
+DECIMAL_SEPARATORS = {',': '.', ';': ','}
 
-def read_statement(statement, account_id):
-    # return if the statement file is too large -> to review!
-    if statement.multiple_chunks():
-        return ['File too large', 'Choose a smaller one']
 
-    statement_data = statement.read().decode("utf-8")
-    lines = statement_data.strip().split("\n")
-    
-    transaction_list = []
-    account = Account.objects.get(pk=account_id)
-    for line in lines[1:]:
-        fields = line.strip().split('\t')
-        fields.insert(0, account.name)
-        fields.insert(3, 'New')
-        fields.insert(4, '')
-        transaction_list.append(fields)   
-    return transaction_list
+def parse_amount(text, decimal=None):
+    text = text.strip().replace(' ', '')
+    separators = [char for char in text if char in '.,']
+    if separators:
+        if len(set(separators)) == 2 or len(separators) == 1 and len(text.rpartition(separators[0])[2]) != 3:
+            # 1.234,56 and 9,65 end in the decimal separator
+            decimal = separators[-1]
+        elif len(separators) > 1:
+            # 1,234,567 repeats the thousands separator
+            decimal = '.' if separators[0] == ',' else ','
+        elif decimal is None:
+            raise ValueError('Amount {} could be read with either decimal separator'.format(text))
+        thousands = ',' if decimal == '.' else '.'
+        match = re.fullmatch(r'([+-]?(?:\d{{1,3}}(?:{0}\d{{3}})+|\d+))(?:{1}(\d+))?'.format(re.escape(thousands), re.escape(decimal)), text)
+        if not match:
+            raise ValueError('Amount {} could not be read'.format(text))
+        text = match.group(1).replace(thousands, '') + ('.' + match.group(2) if match.group(2) else '')
+    return Decimal(text)
+
+
+STATEMENT_COLUMNS = {
+    'date': ('date',),
+    'description': ('description', 'payee', 'details', 'memo', 'narrative'),
+    'amount': ('value', 'amount'),
+}
+
+
+def iter_statement(statement):
+    # yield (date, description, amount) rows with constant memory whatever the file size
+    lines = (line for line in iter_lines(statement.chunks()) if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return
+    delimiter = max('\t,;', key=first.count)
+    reader = csv.reader(itertools.chain([first], lines), delimiter=delimiter)
+
+    # columns are taken from the header row when there is one, in date, description, value order otherwise
+    columns = {'date': 0, 'description': 1, 'amount': 2}
+    row = [field.strip() for field in next(reader)]
+    try:
+        parse_date(row[0])
+    except (ValueError, IndexError):
+        header = [field.lower() for field in row]
+        for column, names in STATEMENT_COLUMNS.items():
+            for i, field in enumerate(header):
+                if field in names:
+                    columns[column] = i
+                    break
+        row = None
+
+    for line_number, fields in enumerate(itertools.chain([row] if row else [], reader), start=1):
+        fields = [field.strip() for field in fields]
+        try:
+            yield (
+                parse_date(fields[columns['date']]),
+                fields[columns['description']],
+                parse_amount(fields[columns['amount']], DECIMAL_SEPARATORS.get(delimiter)),
+            )
+        except (ValueError, IndexError, InvalidOperation):
+            raise ValueError('Line {} could not be read: {}'.format(line_number, delimiter.join(fields)))
+
+
+STAGING_BATCH_SIZE = 500
+
+
+def iter_batches(lines, size=STAGING_BATCH_SIZE):
+    # pk ordered batches, safe to update while walking them
+    last_pk = 0
+    while True:
+        batch = list(lines.filter(pk__gt=last_pk).order_by('pk')[:size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def stage_lines(statement_import, statement, progress=None):
+    # the parsed lines go straight to the staging table in batches
+    count = 0
+    batch = []
+    for date, description, amount in iter_statement(statement):
+        batch.append(StagedLine(statement_import=statement_import, date=date, payee=description, amount=amount))
+        if len(batch) == STAGING_BATCH_SIZE:
+            StagedLine.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+            if progress:
+                progress(count)
+    StagedLine.objects.bulk_create(batch)
+    return count + len(batch)
+
+
+def stage_statement(statement, account):
+    with db_transaction.atomic():
+        statement_import = StatementImport.objects.create(account=account)
+        stage_lines(statement_import, statement)
+    return statement_import
+
+
+# process-wide payee name -> alias map, cleared by the signals whenever payees or aliases change
+PAYEE_CACHE = {'aliases': None, 'index': None, 'hits': 0, 'matches': 0, 'misses': 0}
+
+# words dropped from bank descriptions before fuzzy matching
+PAYEE_NOISE_WORDS = {
+    'LONDON', 'GB', 'GBR', 'UK', 'IE', 'IRL', 'US', 'USA',
+    'CARD', 'CD', 'VIS', 'VISA', 'POS', 'CNP', 'REF', 'LTD', 'PLC',
+}
+PAYEE_MATCH_THRESHOLD = 0.6
+
+
+def get_payee_aliases():
+    aliases = PAYEE_CACHE['aliases']
+    if aliases is None:
+        aliases = {payee.name: payee.alias for payee in Payee.objects.select_related('alias__category', 'alias__subcategory')}
+        PAYEE_CACHE['aliases'] = aliases
+    return aliases
+
+
+def clear_payee_cache():
+    PAYEE_CACHE['aliases'] = None
+    PAYEE_CACHE['index'] = None
+
+
+def payee_cache_stats():
+    return {
+        'hits': PAYEE_CACHE['hits'],
+        'matches': PAYEE_CACHE['matches'],
+        'misses': PAYEE_CACHE['misses'],
+        'loaded': PAYEE_CACHE['aliases'] is not None,
+    }
+
+
+def normalize_payee(name):
+    # split on punctuation and drop words with digits (store numbers, card references) and locations
+    words = []
+    for word in re.split(r'[^A-Z0-9]+', name.upper()):
+        if word and not any(character.isdigit() for character in word) and word not in PAYEE_NOISE_WORDS:
+            words.append(word)
+    return ' '.join(words)
+
+
+def trigrams(text):
+    text = '  {} '.format(text)
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_payee_index():
+    # trigram -> positions of the normalized payee names containing it
+    index = PAYEE_CACHE['index']
+    if index is None:
+        names = {}
+        for name, alias in get_payee_aliases().items():
+            normalized = normalize_payee(name)
+            if normalized:
+                names[normalized] = alias
+        index = {'entries': list(names.items()), 'sizes': [], 'postings': {}}
+        for position, (normalized, alias) in enumerate(index['entries']):
+            grams = trigrams(normalized)
+            index['sizes'].append(len(grams))
+            for gram in grams:
+                index['postings'].setdefault(gram, []).append(position)
+        PAYEE_CACHE['index'] = index
+    return index
+
+
+def match_payee(name, limit=5):
+    # aliases ranked by the trigram similarity of their payees to name
+    grams = trigrams(normalize_payee(name))
+    index = get_payee_index()
+    common = Counter()
+    for gram in grams:
+        common.update(index['postings'].get(gram, ()))
+    scores = (
+        (count / (len(grams) + index['sizes'][position] - count), position)
+        for position, count in common.items()
+    )
+    return [(index['entries'][position][1], score) for score, position in heapq.nlargest(limit, scores)]
 
 
 def assign_alias(transaction_list):
+    aliases = get_payee_aliases()
     new_payees = []
     for transaction in transaction_list:
-        try:
-            payee = Payee.objects.get(name=transaction[2])
-            transaction[2] = payee.alias.name
-            if payee.alias.category:
-                transaction[3] = payee.alias.category.name
-            else:
-                transaction[3] = ''
-            if payee.alias.subcategory:
-                transaction[4] = payee.alias.subcategory.name
-        except Payee.DoesNotExist:
-            if transaction[2] not in new_payees:
-                new_payees.append(transaction[2])
+        alias = aliases.get(transaction.payee)
+        if alias:
+            PAYEE_CACHE['hits'] += 1
+            transaction.alias = alias
+            continue
+        # fall back to the closest known payee
+        candidates = match_payee(transaction.payee, limit=1)
+        if candidates and candidates[0][1] >= PAYEE_MATCH_THRESHOLD:
+            PAYEE_CACHE['matches'] += 1
+            transaction.alias = candidates[0][0]
+            continue
+        PAYEE_CACHE['misses'] += 1
+        if transaction.payee not in new_payees:
+            new_payees.append(transaction.payee)
     return transaction_list, new_payees
-        
 
+
+def get_new_payees(statement_import, limit=None):
+    # unresolved payees in the order they first appear in the statement
+    payees = statement_import.stagedline_set.filter(alias=None).values('payee').annotate(first=Min('pk')).order_by('first')
+    if limit:
+        payees = payees[:limit]
+    return [payee['payee'] for payee in payees]
+
+
+def resolve_import(statement_import):
+    for batch in iter_batches(statement_import.stagedline_set.filter(alias=None)):
+        assign_alias(batch)
+        StagedLine.objects.bulk_update(batch, ['alias'])
+    return get_new_payees(statement_import)
+
+
+def parse_date(text):
+    # statements use dd/mm/yyyy, yyyy/mm/dd is accepted too
+    date_list = text.split('/')
+    if len(date_list[0]) == 4:
+        year, month, day = date_list
+    else:
+        day, month, year = date_list
+    return datetime.date(int(year), int(month), int(day))
+
+
+def build_transactions(lines, account):
+    # the transactions of each line, its leg in the statement account first
+    double_entries = {
+        double_entry.alias_id: double_entry.account_b
+        for double_entry in DoubleEntry.objects.filter(alias__in={line.alias_id for line in lines}).select_related('account_b')
+    }
+
+    legs = []
+    for line in lines:
+        line_legs = [Transaction(date=line.date, alias_id=line.alias_id, amount=line.amount, account=account)]
+
+        # add the double entry leg if required
+        account_b = double_entries.get(line.alias_id)
+        if account_b:
+            amount = line.amount
+            if account.type == account_b.type:
+                amount = -amount
+            line_legs.append(Transaction(date=line.date, alias_id=line.alias_id, amount=amount, account=account_b))
+        legs.append(line_legs)
+    return legs
+
+
+def transaction_key(account_id, date, alias_id, amount):
+    return account_id, date, alias_id, Decimal(amount).quantize(Decimal('0.01'))
+
+
+def transaction_digest(key, occurrence):
+    # the occurrence number keeps legitimate same-day duplicates apart
+    return hashlib.sha1('{}|{}|{}|{}|{}'.format(*key, occurrence).encode()).hexdigest()
+
+
+def find_duplicates(transactions):
+    # match unsaved transactions against the existing rows of the same accounts and
+    # date span as a multiset, so repeated lines are only dropped as often as they exist
+    if not transactions:
+        return []
+    dates = [transaction.date for transaction in transactions]
+    rows = Transaction.objects.filter(
+        account__in={transaction.account_id for transaction in transactions}, date__range=(min(dates), max(dates))
+    ).values_list('account', 'date', 'alias', 'amount', 'digest')
+    existing, digests = Counter(), set()
+    for account_id, date, alias_id, amount, digest in rows:
+        existing[transaction_key(account_id, date, alias_id, amount)] += 1
+        digests.add(digest)
+
+    seen = Counter()
+    duplicates = []
+    for transaction in transactions:
+        key = transaction_key(transaction.account_id, transaction.date, transaction.alias_id, transaction.amount)
+        occurrence = seen[key]
+        seen[key] += 1
+        duplicates.append(occurrence < existing[key])
+        # skip digests already taken, e.g. when an earlier copy was deleted
+        while transaction_digest(key, occurrence) in digests:
+            occurrence += 1
+        transaction.digest = transaction_digest(key, occurrence)
+        digests.add(transaction.digest)
+    return duplicates
+
+
+def find_line_duplicates(lines, account):
+    # a line is saved already when its leg in the statement account is, the double entry
+    # leg is kept or dropped with it so the two legs are never split
+    legs = build_transactions(lines, account)
+    duplicates = find_duplicates(list(itertools.chain.from_iterable(legs)))
+    line_duplicates, start = [], 0
+    for line_legs in legs:
+        line_duplicates.append(duplicates[start])
+        start += len(line_legs)
+    return legs, line_duplicates
+
+
+def mark_duplicates(statement_import):
+    lines = list(statement_import.stagedline_set.exclude(alias=None).order_by('pk'))
+    legs, duplicates = find_line_duplicates(lines, statement_import.account)
+    for line, duplicate in zip(lines, duplicates):
+        line.duplicate = duplicate
+    StagedLine.objects.bulk_update(lines, ['duplicate'], batch_size=STAGING_BATCH_SIZE)
+    return duplicates.count(True)
+
+
+def save_transactions(lines, account):
+    legs, duplicates = find_line_duplicates(lines, account)
+    # lines already saved are dropped again, the unique digest guards against concurrent imports
+    transactions = [transaction for line_legs, duplicate in zip(legs, duplicates) if not duplicate for transaction in line_legs]
+
+    # bulk_create skips the model signals, so rollups and checkpoints are updated here
+    earliest = {}
+    for transaction in transactions:
+        if transaction.account_id not in earliest or transaction.date < earliest[transaction.account_id]:
+            earliest[transaction.account_id] = transaction.date
+    with db_transaction.atomic():
+        if transactions:
+            ledger_changed()
+        Transaction.objects.bulk_create(transactions, batch_size=500)
+        update_rollups(transactions)
+        for account_id, date in earliest.items():
+            invalidate_checkpoints(account_id, date)
+    return transactions
+
+
+def save_import(statement_import):
+    lines = list(statement_import.stagedline_set.exclude(alias=None).order_by('pk'))
+    with db_transaction.atomic():
+        transactions = save_transactions(lines, statement_import.account)
+        statement_import.delete()
+    return transactions
+
+
+def prepare_statement(path, aliases=None):
+    # parse a statement file and match its payees, in a pool worker the parent's payee map is handed over
+    if aliases is not None:
+        PAYEE_CACHE['aliases'] = aliases
+        PAYEE_CACHE['index'] = None
+    result = {'lines': [], 'new_payees': [], 'error': ''}
+    try:
+        with open(path, 'rb') as statement:
+            lines = [StagedLine(date=date, payee=description, amount=amount) for date, description, amount in iter_statement(File(statement))]
+    except ValueError as error:
+        result['error'] = str(error)
+        return result
+    lines, result['new_payees'] = assign_alias(lines)
+    result['lines'] = [(line.date, line.payee, line.amount, line.alias_id) for line in lines]
+    return result
+
+
+def prepare_statements(paths, workers=None):
+    # the workers only parse and match, they never open a database connection
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    if workers <= 1:
+        return [prepare_statement(path) for path in paths]
+    aliases = get_payee_aliases()
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+        return list(executor.map(prepare_statement, paths, itertools.repeat(aliases)))
+
+
+def import_statements(statements, workers=None):
+    # statements are (path, account) pairs, parsed in parallel and written in one serialized step
+    results = prepare_statements([path for path, account in statements], workers)
+    with db_transaction.atomic():
+        for (path, account), result in zip(statements, results):
+            result['saved'] = 0
+            # a statement with unknown payees is left for the upload pages
+            if result['error'] or result['new_payees']:
+                continue
+            lines = [StagedLine(date=date, payee=payee, amount=amount, alias_id=alias_id) for date, payee, amount, alias_id in result['lines']]
+            result['saved'] = len(save_transactions(lines, account))
+    return results
+
+
+# statement imports queued in the database and run by the process_imports worker
+
+def claim_import_job():
+    # the conditional update is the lock, only one worker moves a queued job on
+    queued = ImportJob.objects.filter(status=ImportJob.QUEUED).exclude(kind=ImportJob.IMPORT).order_by('pk')
+    for pk in queued.values_list('pk', flat=True)[:10]:
+        now = timezone.now()
+        if ImportJob.objects.filter(pk=pk, status=ImportJob.QUEUED).update(status=ImportJob.RUNNING, started=now, updated=now):
+            return ImportJob.objects.select_related('statement_import__account').get(pk=pk)
+    return None
+
+
+def report_progress(job, lines):
+    job.lines = lines
+    ImportJob.objects.filter(pk=job.pk).update(lines=lines, updated=timezone.now())
+
+
+def finish_job(job):
+    # only a running job is finished, one failed meanwhile as left behind is not revived
+    job.finished = timezone.now()
+    return ImportJob.objects.filter(pk=job.pk, status=ImportJob.RUNNING).update(
+        statement_import=job.statement_import, status=job.status, lines=job.lines, total=job.total, error=job.error, finished=job.finished)
+
+
+def run_import_job(job):
+    # payees created by the web process only clear its own cache, the worker reloads them per job
+    clear_payee_cache()
+    statement_import = job.statement_import
+    try:
+        if statement_import is None:
+            raise ValueError('The statement import no longer exists')
+        if job.kind == ImportJob.STAGE:
+            job.lines = job.total = stage_lines(statement_import, statement_import.statement, lambda lines: report_progress(job, lines))
+            resolve_import(statement_import)
+            # the staged lines replace the uploaded file
+            statement_import.statement.delete()
+        else:
+            job.total = statement_import.stagedline_set.exclude(alias=None).count()
+            ImportJob.objects.filter(pk=job.pk).update(total=job.total, updated=timezone.now())
+            save_import(statement_import)
+            job.statement_import = None
+            job.lines = job.total
+        job.status = ImportJob.DONE
+    except Exception as error:
+        # a statement that cannot be read fails its job, anything else is raised for the worker to log
+        job.status = ImportJob.FAILED
+        job.error = str(error) or type(error).__name__
+        if job.kind == ImportJob.STAGE and statement_import:
+            statement_import.delete()
+            job.statement_import = None
+        if not isinstance(error, ValueError):
+            raise
+    finally:
+        finish_job(job)
+    return job
+
+
+def claim_import_batch():
+    # every queued multi-file import is run together
+    queued = ImportJob.objects.filter(status=ImportJob.QUEUED, kind=ImportJob.IMPORT).order_by('pk')
+    pks = [
+        pk for pk in queued.values_list('pk', flat=True)
+        if ImportJob.objects.filter(pk=pk, status=ImportJob.QUEUED).update(status=ImportJob.RUNNING, started=timezone.now(), updated=timezone.now())
+    ]
+    return list(ImportJob.objects.filter(pk__in=pks).select_related('statement_import__account').order_by('pk'))
+
+
+def run_import_batch(jobs, workers=None):
+    clear_payee_cache()
+    statements = [(job.statement_import.statement.path, job.statement_import.account) if job.statement_import else None for job in jobs]
+    try:
+        results = import_statements([statement for statement in statements if statement], workers)
+    except Exception as error:
+        ImportJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status=ImportJob.FAILED, error=str(error) or type(error).__name__, finished=timezone.now())
+        raise
+    results = iter(results)
+    for job, statement in zip(jobs, statements):
+        job.status = ImportJob.FAILED
+        if statement is None:
+            job.error = 'The statement import no longer exists'
+        else:
+            result = next(results)
+            job.total = len(result['lines'])
+            job.lines = result['saved']
+            job.status = ImportJob.DONE
+            if result['error'] or result['new_payees']:
+                job.status = ImportJob.FAILED
+                job.error = result['error'] or 'New payees {}, upload this statement on its own to create them'.format(', '.join(result['new_payees']))
+            # the lines are saved or reported, the uploaded file is not needed anymore
+            job.statement_import.delete()
+            job.statement_import = None
+        finish_job(job)
+    return jobs
+
+
+def fail_stale_jobs(timeout=None):
+    # a running job without progress for that long was left behind by a worker that stopped
+    if timeout is None:
+        timeout = settings.ACCOUNTS_IMPORT_JOB_TIMEOUT
+    stale = ImportJob.objects.filter(status=ImportJob.RUNNING, updated__lt=timezone.now() - datetime.timedelta(seconds=timeout))
+    failed = []
+    for job in stale.select_related('statement_import'):
+        if not ImportJob.objects.filter(pk=job.pk, status=ImportJob.RUNNING).update(
+                status=ImportJob.FAILED, error='The import worker stopped before this import finished', finished=timezone.now()):
+            continue
+        # a save is a single atomic write so its import can be saved again, partly staged lines cannot be used
+        if job.kind != ImportJob.SAVE and job.statement_import:
+            job.statement_import.delete()
+        failed.append(job)
+    return failed
+
+
+def run_reported(report, jobs, function, *args):
+    if report is None:
+        return function(*args)
+    try:
+        function(*args)
+    except Exception as error:
+        report(jobs, error)
+    else:
+        report(jobs, None)
+
+
+def run_import_jobs(workers=None, report=None):
+    # runs the queue until it is empty, report(jobs, error) is called after every run and
+    # errors are raised when there is no report
+    fail_stale_jobs()
+    count = 0
+    while True:
+        jobs = claim_import_batch()
+        job = claim_import_job()
+        if not jobs and not job:
+            return count
+        if jobs:
+            run_reported(report, jobs, run_import_batch, jobs, workers)
+        if job:
+            run_reported(report, [job], run_import_job, job)
+        count += len(jobs) + bool(job)
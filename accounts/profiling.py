@@ -0,0 +1,163 @@
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+
+
+# per-request SQL and timing profile for a sampled share of requests, reported in a
+# Server-Timing header and optionally logged as one JSON line per request
+
+logger = logging.getLogger(__name__)
+
+# profile of the request being handled, None when the request is not sampled.
+# a context variable so the queries of async views running in worker threads are counted too
+PROFILE = ContextVar('accounts_profile', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    profile = PROFILE.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile['queries'].append((sql, time.perf_counter() - start))
+
+
+def install_wrapper(connection, **kwargs):
+    # first in the list so the connection.execute_wrapper() blocks of other code can still pop their own
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+connection_created.connect(install_wrapper)
+
+
+@contextmanager
+def timed(name):
+    # time a block of the current request, e.g. one of the report aggregations
+    profile = PROFILE.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile['spans'].append((name, time.perf_counter() - start))
+
+
+def fingerprint(sql):
+    # literals and placeholder lists collapse so the same query with other parameters matches
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql).replace('%s', '?')
+    return re.sub(r'\?(?:\s*,\s*\?)+', '?', sql)
+
+
+# transaction control repeats in every atomic block, it is not reported as a repeated query
+TRANSACTION_STATEMENT = re.compile(r'\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+
+
+def start_profile():
+    rate = settings.ACCOUNTS_PROFILING_SAMPLE_RATE
+    if not rate or random.random() >= rate:
+        return None
+    return {'start': time.perf_counter(), 'queries': [], 'spans': []}
+
+
+def get_summary(request, response, profile):
+    total = time.perf_counter() - profile['start']
+    spans = {}
+    for name, duration in profile['spans']:
+        spans[name] = spans.get(name, 0) + duration
+    fingerprints = Counter(fingerprint(sql) for sql, duration in profile['queries'] if not TRANSACTION_STATEMENT.match(sql))
+    match = getattr(request, 'resolver_match', None)
+    return {
+        'method': request.method,
+        'path': request.path,
+        'view': match.view_name if match else None,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 3),
+        'view_ms': round((total - spans.get('template', 0)) * 1000, 3),
+        'sql_ms': round(sum(duration for sql, duration in profile['queries']) * 1000, 3),
+        'queries': len(profile['queries']),
+        # the same statement run again and again usually means a query inside a loop
+        'duplicates': [{'sql': sql, 'count': count} for sql, count in fingerprints.most_common() if count > 1],
+        'spans': {name: round(duration * 1000, 3) for name, duration in spans.items()},
+    }
+
+
+def server_timing(summary):
+    metrics = [
+        'total;dur={:.1f}'.format(summary['total_ms']),
+        'view;dur={:.1f}'.format(summary['view_ms']),
+        'sql;dur={:.1f};desc="{} queries"'.format(summary['sql_ms'], summary['queries']),
+    ]
+    repeated = sum(duplicate['count'] - 1 for duplicate in summary['duplicates'])
+    if repeated:
+        metrics.append('sql-repeats;desc="{} repeated queries"'.format(repeated))
+    for name, duration in summary['spans'].items():
+        metrics.append('{};dur={:.1f}'.format(name, duration))
+    return ', '.join(metrics)
+
+
+def finish_profile(request, response, profile):
+    summary = get_summary(request, response, profile)
+    response['Server-Timing'] = server_timing(summary)
+    if settings.ACCOUNTS_PROFILING_LOG:
+        logger.info(json.dumps(summary))
+    return response
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        for connection in connections.all():
+            install_wrapper(connection)
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the instance as a coroutine function as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        profile = start_profile()
+        if profile is None:
+            return self.get_response(request)
+        token = PROFILE.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            PROFILE.reset(token)
+        return finish_profile(request, response, profile)
+
+    async def __acall__(self, request):
+        profile = start_profile()
+        if profile is None:
+            return await self.get_response(request)
+        token = PROFILE.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            PROFILE.reset(token)
+        return finish_profile(request, response, profile)
+
+    def process_template_response(self, request, response):
+        # TemplateResponses are rendered after the view returns, the render is timed on its own
+        profile = PROFILE.get()
+        if profile is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(lambda response: profile['spans'].append(('template', time.perf_counter() - start)))
+        return response
@@ -0,0 +1,82 @@
+from django.db import transaction as db_transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Account, Alias, Category, Parameters, Payee, StatementImport, Subcategory, Transaction
+from . import modules
+
+
+# keep the monthly rollups and balance checkpoints in step with every single-row write
+
+@receiver(pre_save, sender=Transaction)
+def remember_previous_transaction(sender, instance, raw=False, **kwargs):
+    instance._previous = None
+    if instance.pk and not raw:
+        instance._previous = Transaction.objects.filter(pk=instance.pk).first()
+
+
+# the ledger version is bumped first, which also takes the lock get_checkpoints waits on
+
+@receiver(post_save, sender=Transaction)
+def rollup_saved_transaction(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous', None)
+    with db_transaction.atomic():
+        modules.ledger_changed()
+        if previous:
+            modules.update_rollups([previous], sign=-1)
+            modules.invalidate_checkpoints(previous.account_id, previous.date)
+        modules.update_rollups([instance])
+        modules.invalidate_checkpoints(instance.account_id, instance.date)
+
+
+@receiver(post_delete, sender=Transaction)
+def rollup_deleted_transaction(sender, instance, **kwargs):
+    with db_transaction.atomic():
+        modules.ledger_changed()
+        modules.update_rollups([instance], sign=-1)
+        modules.invalidate_checkpoints(instance.account_id, instance.date)
+
+
+@receiver(post_save, sender=Account)
+def invalidate_account_checkpoints(sender, instance, created=False, raw=False, **kwargs):
+    # the initial balance is part of every checkpoint
+    if not created and not raw:
+        with db_transaction.atomic():
+            modules.ledger_changed()
+            instance.balancecheckpoint_set.all().delete()
+
+
+@receiver(post_save, sender=Payee)
+@receiver(post_delete, sender=Payee)
+@receiver(post_save, sender=Alias)
+@receiver(post_delete, sender=Alias)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Subcategory)
+@receiver(post_delete, sender=Subcategory)
+def clear_payee_cache(sender, **kwargs):
+    modules.clear_payee_cache()
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+@receiver(post_save, sender=Alias)
+@receiver(post_delete, sender=Alias)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Subcategory)
+@receiver(post_delete, sender=Subcategory)
+@receiver(post_save, sender=Parameters)
+def bump_ledger_version(sender, raw=False, **kwargs):
+    # every cached page shows names and totals of these rows
+    if not raw:
+        modules.ledger_changed()
+
+
+@receiver(post_delete, sender=StatementImport)
+def delete_statement_file(sender, instance, **kwargs):
+    if instance.statement:
+        instance.statement.delete(save=False)
+
@@ -1,8 +1,10 @@
+from django.db import connection
+from django.db.models import Sum
 from django.test import TestCase
 from decimal import Decimal
 import datetime
 
-from .models import Transaction, Alias, Category, Subcategory, Account, DoubleEntry
+from .models import Transaction, Alias, Category, Subcategory, Account, DoubleEntry, Money
 
 
 class TransactionModelTest(TestCase):
@@ -63,3 +65,39 @@ class TransactionModelTest(TestCase):
         self.assertEqual(double_entry.alias.subcategory, None)
         self.assertEqual(double_entry.account_a, account_a)
         self.assertEqual(double_entry.account_b, account_b)
+
+
+class MoneyFieldTest(TestCase):
+    def setUp(self):
+        self.alias = Alias.objects.create(name='CURZON CINEMA')
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=Decimal('123456789.99'))
+
+    def stored(self, transaction):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT amount FROM accounts_transaction WHERE id = %s', [transaction.pk])
+            return cursor.fetchone()[0]
+
+    def test_money_rounds_to_cents(self):
+        self.assertEqual(Money('9.655'), Decimal('9.66'))
+        self.assertEqual(Money(9.65).cents, 965)
+        self.assertEqual(Money(-0.1).cents, -10)
+        self.assertEqual(Money.from_cents(-1513), Decimal('-15.13'))
+
+    def test_amounts_stored_as_cents(self):
+        transaction = Transaction.objects.create(date=datetime.date(2021, 10, 25), alias=self.alias, amount=9.65, account=self.account)
+        self.assertEqual(self.stored(transaction), 965)
+        transaction.refresh_from_db()
+        self.assertIsInstance(transaction.amount, Money)
+        self.assertEqual(str(transaction.amount), '9.65')
+
+    def test_balances_beyond_decimal_limit(self):
+        # the decimal columns were capped at 8 digits
+        account = Account.objects.get(pk=self.account.pk)
+        self.assertEqual(account.initial_balance, Decimal('123456789.99'))
+
+    def test_sums_are_exact(self):
+        for i in range(10):
+            Transaction.objects.create(date=datetime.date(2021, 10, 25), alias=self.alias, amount=0.1, account=self.account)
+        total = Transaction.objects.aggregate(total=Sum('amount'))['total']
+        self.assertEqual(total, Decimal('1.00'))
+        self.assertIsInstance(total, Money)
@@ -0,0 +1,622 @@
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F, Sum
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
+import os
+import shutil
+import tempfile
+from unittest import mock, skipUnless
+from decimal import Decimal
+import datetime
+
+from . import analytics, bench, modules
+from .models import Transaction, Alias, Category, Subcategory, Account, MonthlyRollup, BalanceCheckpoint, Payee, StatementImport, StagedLine, LedgerVersion
+
+
+class AccountTotalsTest(TestCase):
+    def setUp(self):
+        account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        account2 = Account.objects.create(name='CreditCard', type='L', initial_balance=30.50)
+        Account.objects.create(name='Wallet', type='A', initial_balance=20)
+        categ = Category.objects.create(name='Food', type='E')
+        alias = Alias.objects.create(name='CHIPOTLE', category=categ)
+        Transaction.objects.create(date=datetime.date(2021, 10, 27), alias=alias, amount=-10.50, account=account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=alias, amount=-13, account=account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 11), alias=alias, amount=7, account=account2)
+
+
+    def test_add_account_totals_grouped_queries(self):
+        # the first call stores the month-end checkpoints
+        modules.add_account_totals(datetime.date(2021, 11, 11), datetime.date(2021, 10, 31))
+        # then one query over the checkpoints and one over the open month
+        with self.assertNumQueries(2):
+            account_list = modules.add_account_totals(datetime.date(2021, 11, 11), datetime.date(2021, 10, 31))
+            self.assertEqual(len(account_list), 3)
+        # check totals for every date match sum_account
+        for account in account_list:
+            self.assertEqual(account.total, modules.sum_account(account, datetime.date(2021, 11, 11)))
+            self.assertEqual(account.totals[1], modules.sum_account(account, datetime.date(2021, 10, 31)))
+        self.assertEqual(account_list[0].totals, [Decimal('476.50'), Decimal('489.50')])
+        self.assertEqual(account_list[1].totals, [Decimal('37.50'), Decimal('30.50')])
+        self.assertEqual(account_list[2].totals, [Decimal('20.00'), Decimal('20.00')])
+
+
+    def test_balance_summary(self):
+        account_list = modules.add_account_totals(datetime.date(2021, 11, 11), datetime.date(2021, 10, 31))
+        self.assertEqual(modules.get_balance_summary(account_list), (Decimal('496.50'), Decimal('37.50')))
+        self.assertEqual(modules.get_balance_summary(account_list, 1), (Decimal('509.50'), Decimal('30.50')))
+
+
+class ReportTest(TestCase):
+    def setUp(self):
+        account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        account2 = Account.objects.create(name='CreditCard', type='L')
+        food = Category.objects.create(name='Food', type='E')
+        salary = Category.objects.create(name='Salary', type='I')
+        meals = Subcategory.objects.create(name='Meals', category=food)
+        groceries = Subcategory.objects.create(name='Groceries', category=food)
+        chipotle = Alias.objects.create(name='CHIPOTLE', category=food, subcategory=meals)
+        morrison = Alias.objects.create(name='MORRISON', category=food, subcategory=groceries)
+        employer = Alias.objects.create(name='EMPLOYER', category=salary)
+        payment = Alias.objects.create(name='CREDIT CARD PAYMENT')
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=chipotle, amount=-13, account=account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 11), alias=chipotle, amount=7, account=account2)
+        Transaction.objects.create(date=datetime.date(2021, 11, 12), alias=morrison, amount=-4.50, account=account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 25), alias=employer, amount=1000, account=account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 26), alias=payment, amount=-20, account=account)
+        Transaction.objects.create(date=datetime.date(2021, 10, 26), alias=morrison, amount=-8, account=account)
+
+
+    def test_report_tree(self):
+        with self.assertNumQueries(1):
+            category_list = modules.get_report(datetime.date(2021, 11, 30))
+        self.assertEqual([category.name for category in category_list], ['Food', 'Salary'])
+        food, salary = category_list
+        self.assertEqual(food.total, Decimal('24.50'))
+        self.assertEqual(salary.total, Decimal('1000.00'))
+        self.assertEqual([(sub.name, sub.total) for sub in food.subcategories], [('Meals', Decimal('20.00')), ('Groceries', Decimal('4.50'))])
+        self.assertEqual([(alias.name, alias.total) for alias in food.subcategories[0].aliases], [('CHIPOTLE', Decimal('20.00'))])
+        self.assertEqual(salary.subcategories, [])
+        self.assertEqual(modules.get_report_summary(category_list), (Decimal('1000.00'), Decimal('24.50')))
+
+
+    def test_report_matches_helpers(self):
+        balance_date = datetime.date(2021, 11, 30)
+        category_list = modules.get_report(balance_date)
+        for category in category_list:
+            self.assertEqual(category.total, modules.sum_category(category, balance_date))
+            for subcategory in category.subcategories:
+                self.assertEqual(subcategory.total, modules.sum_subcategory(subcategory, balance_date))
+                for alias in subcategory.aliases:
+                    self.assertEqual(alias.total, modules.sum_alias(alias, balance_date))
+
+
+class MonthlyRollupTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A')
+        category = Category.objects.create(name='Food', type='E')
+        self.alias = Alias.objects.create(name='CHIPOTLE', category=category)
+        self.alias2 = Alias.objects.create(name='MORRISON', category=category)
+
+
+    def rollups(self):
+        return list(MonthlyRollup.objects.order_by('year', 'month', 'alias').values_list('year', 'month', 'alias__name', 'total', 'count'))
+
+
+    def test_rollups_follow_writes(self):
+        transaction = Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 9), alias=self.alias, amount=-7, account=self.account)
+        self.assertEqual(self.rollups(), [(2021, 11, 'CHIPOTLE', Decimal('-20.00'), 2)])
+
+        # moving a transaction to another month and alias
+        transaction.date = datetime.date(2021, 10, 30)
+        transaction.alias = self.alias2
+        transaction.save()
+        self.assertEqual(self.rollups(), [(2021, 10, 'MORRISON', Decimal('-13.00'), 1), (2021, 11, 'CHIPOTLE', Decimal('-7.00'), 1)])
+
+        transaction.delete()
+        self.assertEqual(self.rollups(), [(2021, 11, 'CHIPOTLE', Decimal('-7.00'), 1)])
+        # the emptied month is gone, the table is what a rebuild makes of it
+        rollups = self.rollups()
+        modules.rebuild_rollups()
+        self.assertEqual(self.rollups(), rollups)
+
+
+    def test_batched_updates(self):
+        transactions = [
+            Transaction(date=datetime.date(2021, month, 3), alias=alias, amount=-month, account=self.account)
+            for month in range(1, 13) for alias in [self.alias, self.alias2]
+        ]
+        modules.update_rollups(transactions[:12])
+        # one query for the existing rows, one update and one insert whatever the number of keys
+        with self.assertNumQueries(5):
+            modules.update_rollups(transactions)
+        self.assertEqual(MonthlyRollup.objects.count(), 24)
+        self.assertEqual(MonthlyRollup.objects.get(year=2021, month=2, alias=self.alias).total, Decimal('-4.00'))
+        self.assertEqual(MonthlyRollup.objects.get(year=2021, month=2, alias=self.alias).count, 2)
+        self.assertEqual(MonthlyRollup.objects.get(year=2021, month=12, alias=self.alias2).count, 1)
+
+
+    def test_rebuild_rollups(self):
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+        Transaction.objects.create(date=datetime.date(2020, 11, 3), alias=self.alias, amount=-2.50, account=self.account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 9), alias=self.alias2, amount=-7, account=self.account)
+        incremental = self.rollups()
+        MonthlyRollup.objects.all().delete()
+        call_command('rebuild_rollups', stdout=StringIO())
+        self.assertEqual(self.rollups(), incremental)
+        self.assertEqual(len(incremental), 3)
+
+
+class BalanceCheckpointTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=100)
+        self.alias = Alias.objects.create(name='CHIPOTLE')
+        for month in range(1, 13):
+            Transaction.objects.create(date=datetime.date(2020, month, 15), alias=self.alias, amount=-1, account=self.account)
+
+
+    def test_checkpoints_are_reused(self):
+        self.assertEqual(modules.sum_account(self.account, datetime.date(2020, 6, 20)), Decimal('94.00'))
+        self.assertTrue(BalanceCheckpoint.objects.filter(account=self.account, date=datetime.date(2020, 5, 31)).exists())
+        # a later date starts from the stored checkpoint
+        self.assertEqual(modules.sum_account(self.account, datetime.date(2020, 12, 31)), Decimal('88.00'))
+        self.assertEqual(list(BalanceCheckpoint.objects.order_by('date').values_list('date', 'balance')), [
+            (datetime.date(2020, 5, 31), Decimal('95.00')),
+            (datetime.date(2020, 11, 30), Decimal('89.00')),
+        ])
+
+
+    def test_backdated_transaction_invalidates_checkpoints(self):
+        modules.sum_account(self.account, datetime.date(2020, 6, 20))
+        modules.sum_account(self.account, datetime.date(2020, 12, 31))
+        Transaction.objects.create(date=datetime.date(2020, 8, 1), alias=self.alias, amount=-10, account=self.account)
+        self.assertEqual(list(BalanceCheckpoint.objects.values_list('date', flat=True)), [datetime.date(2020, 5, 31)])
+        self.assertEqual(modules.sum_account(self.account, datetime.date(2020, 12, 31)), Decimal('78.00'))
+
+
+    def test_checkpoints_stored_under_the_ledger_lock(self):
+        # an account loaded before another process changed it
+        stale = Account.objects.get(pk=self.account.pk)
+        Account.objects.filter(pk=self.account.pk).update(initial_balance=200)
+        with CaptureQueriesContext(connection) as queries:
+            checkpoints = modules.get_checkpoints([datetime.date(2020, 5, 31)], [stale])
+        self.assertEqual(checkpoints[(stale.pk, datetime.date(2020, 5, 31))], Decimal('195.00'))
+        sql = [query['sql'] for query in queries]
+        lock = next(i for i, query in enumerate(sql) if query.startswith('UPDATE "accounts_ledgerversion"'))
+        insert = next(i for i, query in enumerate(sql) if query.startswith('INSERT OR IGNORE INTO "accounts_balancecheckpoint"'))
+        rollups = next(i for i, query in enumerate(sql) if 'accounts_monthlyrollup' in query)
+        self.assertLess(lock, rollups)
+        self.assertLess(rollups, insert)
+
+
+    def test_initial_balance_change_invalidates_checkpoints(self):
+        modules.sum_account(self.account, datetime.date(2020, 6, 20))
+        self.account.initial_balance = 200
+        self.account.save()
+        self.assertEqual(modules.sum_account(self.account, datetime.date(2020, 6, 20)), Decimal('194.00'))
+
+
+class TransactionIndexTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A')
+        self.alias = Alias.objects.create(name='CHIPOTLE')
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+        # give the planner the statistics of a 1M-row ledger with ~120 months per account
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            cursor.execute("DELETE FROM sqlite_stat1 WHERE tbl = 'accounts_transaction'")
+            cursor.executemany('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (%s, %s, %s)', [
+                ('accounts_transaction', None, '1000000'),
+                ('accounts_transaction', 'transaction_account_date', '1000000 50000 2'),
+                ('accounts_transaction', 'transaction_alias_date', '1000000 500 2'),
+            ])
+            cursor.execute('ANALYZE sqlite_master')
+
+
+    def test_month_filter_plans(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('query plans are checked on sqlite')
+        balance_date = datetime.date(2021, 11, 11)
+        before = Transaction.objects.filter(account=self.account, date__month=balance_date.month).explain()
+        after = Transaction.objects.filter(account=self.account, date__range=modules.month_range(balance_date)).explain()
+        # django_date_extract() hides the date column, only the account part of the index is usable
+        self.assertNotIn('date>?', before, before)
+        self.assertIn('transaction_account_date (account_id=? AND date>? AND date<?)', after, after)
+
+        after = Transaction.objects.filter(alias=self.alias, date__range=modules.month_range(balance_date)).explain()
+        self.assertIn('transaction_alias_date (alias_id=? AND date>? AND date<?)', after, after)
+
+
+    def test_account_totals_plan(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('query plans are checked on sqlite')
+        # the open month is read through the index instead of every transaction of the account
+        plan = Account.objects.annotate(total=modules.month_sum(datetime.date(2021, 11, 11))).explain()
+        self.assertIn('transaction_account_date (account_id=? AND date>? AND date<?)', plan, plan)
+
+
+class StatementParserTest(TestCase):
+    def chunked(self, text, size=7):
+        # an upload that hands the parser a few bytes at a time
+        data = text.encode('utf-8')
+        return mock.Mock(chunks=lambda: (data[i:i + size] for i in range(0, len(data), size)))
+
+
+    def test_creditcard_layout(self):
+        with open('accounts/creditcard.csv', 'rb') as file:
+            rows = list(modules.iter_statement(mock.Mock(chunks=lambda: iter([file.read()]))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0], (datetime.date(2021, 11, 23), 'MORRISON STORE LONDON', Decimal('9.65')))
+
+
+    def test_small_chunks_and_delimiters(self):
+        statement = 'Amount;Date;Payee\r\n-9,65;23/11/2021;CAFÉ NERO\r\n\r\n3,50;2021/11/29;SAINSBURYS\r\n'
+        rows = list(modules.iter_statement(self.chunked(statement)))
+        self.assertEqual(rows, [
+            (datetime.date(2021, 11, 23), 'CAFÉ NERO', Decimal('-9.65')),
+            (datetime.date(2021, 11, 29), 'SAINSBURYS', Decimal('3.50')),
+        ])
+        # no header row, comma separated, last line without newline
+        statement = '23/11/2021,"MORRISON, LONDON",9.65\n24/11/2021,CHIPOTLE,12'
+        rows = list(modules.iter_statement(self.chunked(statement, size=3)))
+        self.assertEqual(rows[0], (datetime.date(2021, 11, 23), 'MORRISON, LONDON', Decimal('9.65')))
+        self.assertEqual(rows[1], (datetime.date(2021, 11, 24), 'CHIPOTLE', Decimal('12')))
+
+
+    def test_thousands_separators(self):
+        self.assertEqual(modules.parse_amount('1.234,56'), Decimal('1234.56'))
+        self.assertEqual(modules.parse_amount('-1,234,567.89'), Decimal('-1234567.89'))
+        self.assertEqual(modules.parse_amount('1.234.567'), Decimal('1234567'))
+        self.assertEqual(modules.parse_amount('9,65'), Decimal('9.65'))
+        # three digits after a single separator are read with the decimal separator of the delimiter
+        self.assertEqual(modules.parse_amount('1,234', '.'), Decimal('1234'))
+        self.assertEqual(modules.parse_amount('1.234', ','), Decimal('1234'))
+        with self.assertRaises(ValueError):
+            modules.parse_amount('1,234')
+        for text in ['1,23,4', '1.234.5,6', '1,234.5,6']:
+            with self.assertRaises(ValueError):
+                modules.parse_amount(text)
+        statement = 'Date;Payee;Amount\n23/11/2021;MORRISON;1.234,56\n24/11/2021;CHIPOTLE;1.234\n'
+        rows = list(modules.iter_statement(self.chunked(statement)))
+        self.assertEqual([row[2] for row in rows], [Decimal('1234.56'), Decimal('1234')])
+        statement = '23/11/2021,MORRISON,"1,234.56"\n24/11/2021,CHIPOTLE,"1,234"\n'
+        rows = list(modules.iter_statement(self.chunked(statement)))
+        self.assertEqual([row[2] for row in rows], [Decimal('1234.56'), Decimal('1234')])
+        # a tab separated export does not tell the decimal separator
+        with self.assertRaisesMessage(ValueError, 'Line 1 could not be read'):
+            list(modules.iter_statement(self.chunked('23/11/2021\tMORRISON\t1,234\n')))
+
+
+    def test_bad_line(self):
+        with self.assertRaisesMessage(ValueError, 'Line 2 could not be read'):
+            list(modules.iter_statement(self.chunked('Date\tDescription\tValue\n23/11/2021\tA\t1\n24/11/2021\tB\tabc\n')))
+
+
+class PayeeCacheTest(TestCase):
+    def setUp(self):
+        modules.clear_payee_cache()
+        self.account = Account.objects.create(name='Creditcard', type='L')
+        category = Category.objects.create(name='Food', type='E')
+        self.alias = Alias.objects.create(name='MORRISON', category=category)
+        Payee.objects.create(name='MORRISON STORE LONDON', alias=self.alias)
+        self.statement_import = StatementImport.objects.create(account=self.account)
+
+
+    def lines(self, *payees):
+        return [StagedLine(statement_import=self.statement_import, date=datetime.date(2021, 11, 23), payee=payee, amount=1) for payee in payees]
+
+
+    def test_assign_alias_single_query(self):
+        stats = modules.payee_cache_stats()
+        with self.assertNumQueries(1):
+            lines, new_payees = modules.assign_alias(self.lines('MORRISON STORE LONDON', 'CHIPOTLE', 'MORRISON STORE LONDON'))
+            self.assertEqual(lines[0].alias.category.name, 'Food')
+        self.assertEqual(new_payees, ['CHIPOTLE'])
+        # later statements are resolved without queries
+        with self.assertNumQueries(0):
+            modules.assign_alias(self.lines('MORRISON STORE LONDON'))
+        self.assertEqual(modules.payee_cache_stats()['hits'], stats['hits'] + 3)
+        self.assertEqual(modules.payee_cache_stats()['misses'], stats['misses'] + 1)
+
+
+    def test_cache_cleared_by_signals(self):
+        modules.assign_alias(self.lines('CHIPOTLE'))
+        Payee.objects.create(name='CHIPOTLE', alias=self.alias)
+        self.assertFalse(modules.payee_cache_stats()['loaded'])
+        lines, new_payees = modules.assign_alias(self.lines('CHIPOTLE'))
+        self.assertEqual(new_payees, [])
+        self.alias.name = 'MORRISONS'
+        self.alias.save()
+        lines, new_payees = modules.assign_alias(self.lines('CHIPOTLE'))
+        self.assertEqual(lines[0].alias.name, 'MORRISONS')
+
+
+    def test_normalize_payee(self):
+        self.assertEqual(modules.normalize_payee('MORRISONS STORE LONDON 123'), 'MORRISONS STORE')
+        self.assertEqual(modules.normalize_payee('Amazon.co.uk*2K3 CARD 4821'), 'AMAZON CO')
+
+
+    def test_fuzzy_match(self):
+        sainsburys = Alias.objects.create(name='SAINSBURYS')
+        Payee.objects.create(name='SAINSBURYS S/MKTS 0412', alias=sainsburys)
+        ranked = modules.match_payee('MORRISONS STORE LONDON 123')
+        self.assertEqual(ranked[0][0], self.alias)
+        self.assertGreater(ranked[0][1], modules.PAYEE_MATCH_THRESHOLD)
+
+        matches = modules.payee_cache_stats()['matches']
+        lines, new_payees = modules.assign_alias(self.lines('MORRISONS STORE LONDON 123', 'SAINSBURYS S/MKTS 0977', 'CHIPOTLE GRILL'))
+        self.assertEqual([line.alias for line in lines[:2]], [self.alias, sainsburys])
+        self.assertEqual(new_payees, ['CHIPOTLE GRILL'])
+        self.assertEqual(modules.payee_cache_stats()['matches'], matches + 2)
+
+
+class LedgerHeadTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        self.alias = Alias.objects.create(name='CHIPOTLE', category=Category.objects.create(name='Food', type='E'))
+
+
+    def test_empty_ledger(self):
+        self.assertEqual(modules.get_ledger_head()['date'], datetime.date.today())
+
+
+    def test_head_cached_until_the_ledger_changes(self):
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+        head = modules.get_ledger_head()
+        self.assertEqual(head['date'], datetime.date(2021, 11, 3))
+        # the version is read, the date comes from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(modules.get_ledger_head(), head)
+
+        transaction = Transaction.objects.create(date=datetime.date(2021, 11, 11), alias=self.alias, amount=-5, account=self.account)
+        self.assertGreater(modules.get_ledger_head()['version'], head['version'])
+        self.assertEqual(modules.get_ledger_head()['date'], datetime.date(2021, 11, 11))
+        transaction.delete()
+        self.assertEqual(modules.get_ledger_head()['date'], datetime.date(2021, 11, 3))
+
+
+    def test_version_shared_between_processes(self):
+        head = modules.get_ledger_head()
+        # a write made by another process reaches this one through the database, not the cache
+        LedgerVersion.objects.filter(pk=1).update(version=F('version') + 1)
+        Transaction.objects.bulk_create([Transaction(date=datetime.date(2021, 12, 5), alias=self.alias, amount=-2, account=self.account)])
+        self.assertEqual(modules.get_ledger_head(), {'date': datetime.date(2021, 12, 5), 'version': head['version'] + 1})
+
+
+    def test_import_moves_the_head(self):
+        modules.get_ledger_head()
+        statement_import = StatementImport.objects.create(account=self.account)
+        StagedLine.objects.create(statement_import=statement_import, date=datetime.date(2021, 12, 1), payee='CHIPOTLE', amount=-7, alias=self.alias)
+        modules.save_import(statement_import)
+        self.assertEqual(modules.get_ledger_head()['date'], datetime.date(2021, 12, 1))
+
+
+class TrendTest(TestCase):
+    def setUp(self):
+        bank = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        card = Account.objects.create(name='CreditCard', type='L')
+        food = Category.objects.create(name='Food', type='E')
+        salary = Category.objects.create(name='Salary', type='I')
+        chipotle = Alias.objects.create(name='CHIPOTLE', category=food)
+        employer = Alias.objects.create(name='EMPLOYER', category=salary)
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=chipotle, amount=-13, account=bank)
+        Transaction.objects.create(date=datetime.date(2021, 12, 9), alias=chipotle, amount=7, account=card)
+        Transaction.objects.create(date=datetime.date(2022, 1, 28), alias=employer, amount=1000, account=bank)
+        Transaction.objects.create(date=datetime.date(2012, 1, 28), alias=employer, amount=900, account=bank)
+
+
+    def test_trend_pivot(self):
+        with self.assertNumQueries(1):
+            trend = modules.get_trend(datetime.date(2021, 10, 15), datetime.date(2022, 1, 31))
+        self.assertEqual(trend['months'], ['2021-10', '2021-11', '2021-12', '2022-01'])
+        food, salary = Category.objects.order_by('name')
+        bank, card = Account.objects.order_by('name')
+        self.assertEqual(trend['categories'], [
+            {'id': food.pk, 'name': 'Food', 'totals': [0, Decimal('13'), Decimal('7'), 0]},
+            {'id': salary.pk, 'name': 'Salary', 'totals': [0, 0, 0, Decimal('1000')]},
+        ])
+        self.assertEqual(trend['accounts'], [
+            {'id': bank.pk, 'name': 'BankAccount', 'totals': [0, Decimal('-13'), 0, Decimal('1000')]},
+            {'id': card.pk, 'name': 'CreditCard', 'totals': [0, 0, Decimal('7'), 0]},
+        ])
+
+
+    def test_same_names_kept_apart(self):
+        # an income and an expense category may share a name, so may two accounts
+        gifts = Category.objects.create(name='Gifts', type='E')
+        gifts_received = Category.objects.create(name='Gifts', type='I')
+        other_bank = Account.objects.create(name='BankAccount', type='A')
+        Transaction.objects.create(date=datetime.date(2021, 11, 5), alias=Alias.objects.create(name='FLORIST', category=gifts), amount=-20, account=other_bank)
+        Transaction.objects.create(date=datetime.date(2021, 11, 6), alias=Alias.objects.create(name='AUNT', category=gifts_received), amount=50, account=other_bank)
+        trend = modules.get_trend(datetime.date(2021, 11, 1), datetime.date(2021, 11, 30))
+        self.assertEqual([(row['id'], row['totals']) for row in trend['categories'] if row['name'] == 'Gifts'], [
+            (gifts.pk, [Decimal('20')]), (gifts_received.pk, [Decimal('50')]),
+        ])
+        self.assertEqual([row['totals'] for row in trend['accounts'] if row['name'] == 'BankAccount'], [[Decimal('-13')], [Decimal('30')]])
+        if analytics.np is not None:
+            self.assertEqual(analytics.get_trend(datetime.date(2021, 11, 1), datetime.date(2021, 11, 30)), trend)
+
+
+    def test_ten_years_one_query(self):
+        with self.assertNumQueries(1):
+            trend = modules.get_trend(datetime.date(2012, 1, 1), datetime.date(2021, 12, 31))
+        self.assertEqual(len(trend['months']), modules.TREND_MAX_MONTHS)
+        self.assertEqual(trend['categories'][1]['totals'][0], Decimal('900'))
+        self.assertEqual(list(modules.trend_rows(trend))[1][:3], ['Category', 'Food', '0.00'])
+
+
+    @skipUnless(analytics.np, 'numpy is not installed')
+    def test_engines_match_after_delete(self):
+        start, end = datetime.date(2021, 11, 1), datetime.date(2021, 11, 30)
+        Transaction.objects.filter(date__range=(start, end)).delete()
+        # a rollup row emptied by hand, as update_rollups used to leave them
+        MonthlyRollup.objects.create(year=2021, month=11, account=Account.objects.get(name='BankAccount'), alias=Alias.objects.get(name='CHIPOTLE'), total=0, count=0)
+        trend = modules.get_trend(start, end)
+        self.assertEqual(trend, {'months': ['2021-11'], 'categories': [], 'accounts': []})
+        self.assertEqual(analytics.get_trend(start, end), trend)
+
+
+class ImportStatementsTest(TestCase):
+    def setUp(self):
+        modules.clear_payee_cache()
+        self.card = Account.objects.create(name='Creditcard', type='L')
+        self.bank = Account.objects.create(name='Bank', type='A')
+        food = Category.objects.create(name='Food', type='E')
+        for name in ['MORRISON', 'SAINSBURYS', 'CAFFE NERO', 'CHIPOTLE']:
+            alias = Alias.objects.create(name=name, category=food)
+            Payee.objects.create(name=name, alias=alias)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        shutil.copy('accounts/creditcard.csv', self.directory)
+        self.write('bank.csv', 'Date\tDescription\tValue\n01/11/2021\tMORRISON\t-5\n02/11/2021\tCHIPOTLE\t-7\n')
+
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory, name), 'w') as statement:
+            statement.write(text)
+        return os.path.join(self.directory, name)
+
+
+    def test_parallel_import(self):
+        bad = self.write('bad.csv', 'Date\tDescription\tValue\n01/11/2021\tMORRISON\tabc\n')
+        unknown = self.write('unknown.csv', '01/11/2021\tUNKNOWN SHOP\t-5\n')
+        statements = [(os.path.join(self.directory, 'creditcard.csv'), self.card), (os.path.join(self.directory, 'bank.csv'), self.bank), (bad, self.bank), (unknown, self.bank)]
+        results = modules.import_statements(statements, workers=2)
+        self.assertEqual([result['saved'] for result in results], [6, 2, 0, 0])
+        self.assertIn('Line 1 could not be read', results[2]['error'])
+        self.assertEqual(results[3]['new_payees'], ['UNKNOWN SHOP'])
+        self.assertEqual(Transaction.objects.filter(account=self.card).count(), 6)
+        self.assertEqual(MonthlyRollup.objects.get(account=self.bank, alias__name='CHIPOTLE').total, Decimal('-7'))
+        # importing the same files again saves nothing
+        results = modules.import_statements(statements, workers=1)
+        self.assertEqual([result['saved'] for result in results], [0, 0, 0, 0])
+
+
+    def test_single_write(self):
+        statements = [(os.path.join(self.directory, 'creditcard.csv'), self.card), (os.path.join(self.directory, 'bank.csv'), self.bank)]
+        # a failure in the last file leaves nothing behind
+        save_transactions = modules.save_transactions
+        def fail_on_bank(lines, account):
+            if account == self.bank:
+                raise RuntimeError
+            return save_transactions(lines, account)
+        with mock.patch.object(modules, 'save_transactions', side_effect=fail_on_bank):
+            with self.assertRaises(RuntimeError):
+                modules.import_statements(statements, workers=1)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+
+    def test_import_statements_command(self):
+        out, err = StringIO(), StringIO()
+        call_command('import_statements', self.directory, '--workers', '2', stdout=out, stderr=err)
+        self.assertEqual(out.getvalue().splitlines(), ['bank.csv: 2 transactions saved into Bank', 'creditcard.csv: 6 transactions saved into Creditcard'])
+        self.assertEqual(Transaction.objects.count(), 8)
+
+
+class BenchTest(TestCase):
+    def ledger(self):
+        return list(Transaction.objects.order_by('pk').values_list('date', 'amount', 'alias__name', 'account__name'))
+
+
+    def test_ledger_is_deterministic(self):
+        self.assertEqual(bench.generate_ledger(accounts=2, categories=3, subcategories=2, payees=20, years=1, per_month=10, seed=3), 120)
+        ledger = self.ledger()
+        statement = bench.generate_statement(lines=30, seed=3)
+        self.assertEqual(Subcategory.objects.count(), 6)
+        self.assertEqual(Payee.objects.count(), 20)
+        self.assertEqual(MonthlyRollup.objects.aggregate(count=Sum('count'))['count'], 120)
+
+        for model in [Account, Category, Alias]:
+            model.objects.all().delete()
+        bench.generate_ledger(accounts=2, categories=3, subcategories=2, payees=20, years=1, per_month=10, seed=3)
+        self.assertEqual([row[1:] for row in self.ledger()], [row[1:] for row in ledger])
+        self.assertEqual(bench.generate_statement(lines=30, seed=3), statement)
+
+
+    def test_run_benchmarks(self):
+        bench.generate_ledger(accounts=2, categories=3, subcategories=2, payees=20, years=1, per_month=10)
+        statement = bench.generate_statement(lines=30)
+        results = bench.run_benchmarks(statement, repeat=1)
+        self.assertIn('view:index', results)
+        self.assertIn('view:alias_history', results)
+        self.assertIn('import:save_statement', results)
+        self.assertGreater(results['view:account_transactions']['queries'], 0)
+        # the writing benchmarks are rolled back
+        self.assertEqual(Transaction.objects.count(), 120)
+        self.assertEqual(StatementImport.objects.count(), 0)
+
+        results = bench.run_benchmarks(statement, repeat=1, only='import:')
+        self.assertEqual(sorted(results), ['import:assign_alias', 'import:read_statement', 'import:save_statement', 'import:stage_statement'])
+
+
+    def test_compare(self):
+        baseline = {'benchmarks': {
+            'view:index': {'median_ms': 10, 'queries': 3},
+            'view:history': {'median_ms': 10, 'queries': 3},
+            'view:trend': {'median_ms': 10, 'queries': 1},
+        }}
+        results = {
+            'view:index': {'median_ms': 11.5, 'queries': 3},
+            'view:history': {'median_ms': 13, 'queries': 3},
+            'view:trend': {'median_ms': 5, 'queries': 2},
+            'view:account_transactions': {'median_ms': 50, 'queries': 5},
+        }
+        self.assertEqual(bench.compare(results, baseline), [
+            'view:history: median 13.0 ms, baseline 10.0 ms',
+            'view:trend: 2 queries, baseline 1',
+        ])
+        self.assertEqual(bench.compare(results, baseline, threshold=0.5), ['view:trend: 2 queries, baseline 1'])
+
+
+    def test_missing_baseline(self):
+        with self.assertRaisesMessage(CommandError, 'Could not read the baseline'):
+            call_command('bench', '--compare', os.path.join(tempfile.gettempdir(), 'no-such-baseline.json'), stdout=StringIO())
+
+
+@skipUnless(analytics.np, 'numpy is not installed')
+class AnalyticsTest(TestCase):
+    def setUp(self):
+        accounts = [
+            Account.objects.create(name='BankAccount', type='A', initial_balance=Decimal('500.10')),
+            Account.objects.create(name='CreditCard', type='L', initial_balance=Decimal('30.07')),
+            Account.objects.create(name='Wallet', type='A'),
+        ]
+        food = Category.objects.create(name='Food', type='E')
+        salary = Category.objects.create(name='Salary', type='I')
+        aliases = [
+            Alias.objects.create(name='CHIPOTLE', category=food),
+            Alias.objects.create(name='EMPLOYER', category=salary),
+            Alias.objects.create(name='CARD PAYMENT'),
+        ]
+        # amounts that drift when summed as floats
+        amounts = [Decimal('0.10'), Decimal('-9.65'), Decimal('0.07'), Decimal('-3.33'), Decimal('1234.56')]
+        Transaction.objects.bulk_create(
+            Transaction(date=datetime.date(2020, 1, 1) + datetime.timedelta(days=i * 7 % 700), alias=aliases[i % 3], amount=amounts[i % 5], account=accounts[i % 3])
+            for i in range(600)
+        )
+        modules.rebuild_rollups()
+
+
+    def test_trend_matches(self):
+        start, end = datetime.date(2020, 2, 10), datetime.date(2021, 8, 3)
+        self.assertEqual(analytics.get_trend(start, end), modules.get_trend(start, end))
+
+
+    def test_trend_view_uses_analytics(self):
+        with override_settings(ACCOUNTS_VECTORIZED_ANALYTICS=True), mock.patch.object(analytics, 'get_trend', wraps=analytics.get_trend) as get_trend:
+            response = self.client.get('/accounts/trend', {'start': '2020-01-01', 'end': '2020-12-31', 'format': 'json'})
+        self.assertEqual(get_trend.call_count, 1)
+        self.assertEqual(response.json(), self.client.get('/accounts/trend', {'start': '2020-01-01', 'end': '2020-12-31', 'format': 'json'}).json())
+
+
+    @override_settings(ACCOUNTS_PAGE_CACHE_SECONDS=0)
+    def test_dashboard_without_analytics(self):
+        expected = self.client.get('/accounts/').content
+        # the balances come from the rollups, the ledger is not loaded on every dashboard visit
+        with override_settings(ACCOUNTS_VECTORIZED_ANALYTICS=True), mock.patch.object(analytics, 'load_ledger') as load_ledger:
+            self.assertEqual(self.client.get('/accounts/').content, expected)
+        self.assertFalse(load_ledger.called)
@@ -1,11 +1,25 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from decimal import Decimal
+from io import StringIO
 import datetime
+import json
+import os
+import tempfile
+import threading
+from unittest import mock
 
+from asgiref.sync import async_to_sync
 from django.test.client import RequestFactory
+from django.utils import timezone
 
+from . import async_views, modules, profiling, views
 from .views import upload_statement
-from .models import Transaction, Payee, Alias, Category, Subcategory, Account, Parameters
+from .models import Transaction, Payee, Alias, Category, Subcategory, Account, Parameters, DoubleEntry, MonthlyRollup, StatementImport, StagedLine, ImportJob
 
 
 class IndexViewsTest(TestCase):
@@ -25,6 +39,13 @@ class IndexViewsTest(TestCase):
         Transaction.objects.create(date=datetime.date(2021, 11, 9), alias=alias2, amount=-11, account=account)
         
 
+    def test_index_empty_ledger(self):
+        Transaction.objects.all().delete()
+        response = self.client.get('/accounts/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['balance_date'], datetime.date.today())
+
+
     def test_index(self):
         response = self.client.get('/accounts/')
         self.assertEqual(response.status_code, 200)
@@ -70,6 +91,15 @@ class IndexViewsTest(TestCase):
         self.assertEqual(response.context['is_account'], True)
 
 
+    def test_account_transactions_same_month_previous_year(self):
+        # november of the previous year is not part of the balance month
+        account = Account.objects.get(pk=1)
+        Transaction.objects.create(date=datetime.date(2020, 11, 5), alias=Alias.objects.get(pk=1), amount=-3, account=account)
+        response = self.client.get('/accounts/1/account')
+        self.assertEqual(response.context['transaction_list'].count(), 2)
+        self.assertEqual(response.context['balance'], Decimal('462.50'))
+
+
     def test_category_transactions(self):
         # check category.id = 1
         response = self.client.get('/accounts/1/category')
@@ -222,25 +252,58 @@ class SelectDateViewTest(TestCase):
 
 class UploadStatementViewTest(TestCase):
     def setUp(self):
+        # the payee cache outlives the rolled back test data
+        modules.clear_payee_cache()
         self.factory = RequestFactory()
         self.account = Account.objects.create(name='Creditcard')
+        # uploaded statements are stored until the worker has read them
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
 
 
-    def test_upload_statement(self):
-        with open('accounts/creditcard.csv') as file:
+    def upload(self, path='accounts/creditcard.csv'):
+        with open(path) as file:
             request = self.factory.post('/accounts/upload/statement', {'account': self.account.id, 'statement': file })
         
         # create session normally created by middleware
         request.session = {}
         response_post = upload_statement(request)
-        transaction_list = request.session['transaction_list']
-        new_payees = request.session['new_payees']
+        # the queued import is run by the worker
+        modules.run_import_jobs()
+        statement_import = StatementImport.objects.filter(pk=request.session['statement_import']).first()
+        return response_post, request.session, statement_import
+
+
+    def test_worker_reloads_payees(self):
+        # payees created in another process leave this process's cache stale
+        modules.get_payee_aliases()
+        alias = Alias.objects.create(name='MORRISON', category=Category.objects.create(name='Food', type='E'))
+        modules.get_payee_aliases()
+        Payee.objects.bulk_create([Payee(name='MORRISON STORE LONDON', alias=alias)])
+        response_post, session, statement_import = self.upload()
+        self.assertNotIn('MORRISON STORE LONDON', modules.get_new_payees(statement_import))
+
+
+    def test_upload_statement(self):
+        response_post, session, statement_import = self.upload()
+        transaction_list = [line.fields for line in statement_import.stagedline_set.order_by('pk')]
+        new_payees = modules.get_new_payees(statement_import)
         self.assertEqual(response_post.status_code, 302)
+        job = ImportJob.objects.get()
+        self.assertEqual(response_post.url, '/accounts/import/{}'.format(job.pk))
+        self.assertEqual((job.status, job.lines, job.total), (ImportJob.DONE, 6, 6))
+        # the staged lines replace the uploaded file
+        self.assertFalse(statement_import.statement)
+        # only the import id is kept in the session
+        self.assertEqual(list(session), ['statement_import'])
         # check some transactions
         self.assertEqual(len(transaction_list), 6)
-        self.assertEqual(transaction_list[0], ['Creditcard', '23/11/2021', 'MORRISON STORE LONDON', 'New', '', '9.65' ])
-        self.assertEqual(transaction_list[1], ['Creditcard', '29/11/2021', 'SAINSBURYS LONDON', 'New', '', '3.5'])
-        self.assertEqual(transaction_list[2], ['Creditcard', '29/11/2021', 'MORRISON STORE LONDON', 'New', '', '4.5'])
+        self.assertEqual(transaction_list[0], ['Creditcard', '23/11/2021', 'MORRISON STORE LONDON', 'New', '', Decimal('9.65') ])
+        self.assertEqual(transaction_list[1], ['Creditcard', '29/11/2021', 'SAINSBURYS LONDON', 'New', '', Decimal('3.5')])
+        self.assertEqual(transaction_list[2], ['Creditcard', '29/11/2021', 'MORRISON STORE LONDON', 'New', '', Decimal('4.5')])
         # check new payees
         self.assertEqual(len(new_payees), 5)
         self.assertEqual(new_payees[0], 'MORRISON STORE LONDON')
@@ -256,23 +319,663 @@ class UploadStatementViewTest(TestCase):
         alias = Alias.objects.create(name='MORRISON', category=category, subcategory=subcategory)
         Payee.objects.create(name='MORRISON STORE LONDON', alias=alias)
 
-        with open('accounts/creditcard.csv') as file:
-            request = self.factory.post('/accounts/upload/statement', {'account': self.account.id, 'statement': file })
-        
-        # create session normally created by middleware
-        request.session = {}
-        response_post = upload_statement(request)
-        transaction_list = request.session['transaction_list']
-        new_payees = request.session['new_payees']
+        response_post, session, statement_import = self.upload()
+        transaction_list = [line.fields for line in statement_import.stagedline_set.order_by('pk')]
+        new_payees = modules.get_new_payees(statement_import)
         self.assertEqual(response_post.status_code, 302)
         # check some transactions
         self.assertEqual(len(transaction_list), 6)
-        self.assertEqual(transaction_list[0], ['Creditcard', '23/11/2021', 'MORRISON', 'Food', 'Groceries', '9.65'])
-        self.assertEqual(transaction_list[1], ['Creditcard', '29/11/2021', 'SAINSBURYS LONDON', 'New', '', '3.5'])
-        self.assertEqual(transaction_list[2], ['Creditcard', '29/11/2021', 'MORRISON', 'Food', 'Groceries', '4.5'])
+        self.assertEqual(transaction_list[0], ['Creditcard', '23/11/2021', 'MORRISON', 'Food', 'Groceries', Decimal('9.65')])
+        self.assertEqual(transaction_list[1], ['Creditcard', '29/11/2021', 'SAINSBURYS LONDON', 'New', '', Decimal('3.5')])
+        self.assertEqual(transaction_list[2], ['Creditcard', '29/11/2021', 'MORRISON', 'Food', 'Groceries', Decimal('4.5')])
         # check new payees
         self.assertEqual(len(new_payees), 4)
         self.assertEqual(new_payees[0], 'SAINSBURYS LONDON')
         self.assertEqual(new_payees[1], 'CAFFE NERO LONDON')
         self.assertEqual(new_payees[2], 'CHIPOTLE GRILL')
-        #check initial names in create payees
\ No newline at end of file
+        #check initial names in create payees
+
+
+    def test_upload_progress(self):
+        path = os.path.join(tempfile.mkdtemp(dir=settings.MEDIA_ROOT), 'long.csv')
+        with open(path, 'w') as file:
+            file.write('Date\tDescription\tValue\n')
+            file.writelines('23/11/2021\tPAYEE {}\t1\n'.format(i % 7) for i in range(1200))
+        progress = []
+        with mock.patch.object(modules, 'report_progress', side_effect=lambda job, lines: progress.append(lines)):
+            response_post, session, statement_import = self.upload(path)
+        self.assertEqual(progress, [500, 1000])
+        self.assertEqual(statement_import.stagedline_set.count(), 1200)
+
+
+    def test_worker_command(self):
+        with open('accounts/creditcard.csv') as file:
+            request = self.factory.post('/accounts/upload/statement', {'account': self.account.id, 'statement': file })
+        request.session = {}
+        upload_statement(request)
+        out = StringIO()
+        call_command('process_imports', '--once', stdout=out)
+        self.assertIn('Stage statement', out.getvalue())
+        self.assertEqual(ImportJob.objects.get().status, ImportJob.DONE)
+        self.assertEqual(StagedLine.objects.count(), 6)
+
+
+    def test_worker_command_logs_errors(self):
+        for _ in range(2):
+            with open('accounts/creditcard.csv') as file:
+                request = self.factory.post('/accounts/upload/statement', {'account': self.account.id, 'statement': file })
+            request.session = {}
+            upload_statement(request)
+        out, err = StringIO(), StringIO()
+        # the worker logs the error and goes on with the next job
+        with mock.patch.object(modules, 'resolve_import', side_effect=[RuntimeError('disk full'), None]):
+            call_command('process_imports', '--once', stdout=out, stderr=err)
+        self.assertIn('RuntimeError: disk full', err.getvalue())
+        self.assertEqual(out.getvalue().count('Stage statement'), 2)
+        self.assertEqual(sorted(ImportJob.objects.values_list('status', flat=True)), [ImportJob.DONE, ImportJob.FAILED])
+
+
+    def test_upload_statements(self):
+        Account.objects.create(name='Bank', type='A')
+        category = Category.objects.create(name='Food', type='E')
+        for name in ['MORRISON', 'SAINSBURYS', 'CAFFE NERO', 'CHIPOTLE']:
+            Payee.objects.create(name=name, alias=Alias.objects.create(name=name, category=category))
+        path = os.path.join(tempfile.mkdtemp(dir=settings.MEDIA_ROOT), 'bank.csv')
+        with open(path, 'w') as file:
+            file.write('01/11/2021\tUNKNOWN SHOP\t-5\n')
+        data = {'form-TOTAL_FORMS': 3, 'form-INITIAL_FORMS': 0, 'form-0-account': self.account.pk, 'form-1-account': Account.objects.get(name='Bank').pk}
+        with open('accounts/creditcard.csv') as card, open(path) as bank:
+            response = self.client.post('/accounts/upload/statements', dict(data, **{'form-0-statement': card, 'form-1-statement': bank}))
+        self.assertEqual(response.url, '/accounts/import/jobs')
+        self.assertContains(self.client.get(response.url), 'Waiting for the import worker')
+
+        modules.run_import_jobs(workers=2)
+        response = self.client.get(response.url)
+        self.assertEqual([(job.name, job.status, job.lines) for job in response.context['jobs']], [('creditcard.csv', 'done', 6), ('bank.csv', 'failed', 0)])
+        self.assertContains(response, 'New payees UNKNOWN SHOP')
+        self.assertEqual(Transaction.objects.count(), 6)
+        # the uploaded files are removed once imported
+        self.assertEqual(StatementImport.objects.count(), 0)
+
+
+    def test_upload_bad_statement(self):
+        path = os.path.join(tempfile.mkdtemp(dir=settings.MEDIA_ROOT), 'bad.csv')
+        with open(path, 'w') as file:
+            file.write('Date\tDescription\tValue\n23/11/2021\tA\t1\n24/11/2021\tB\tabc\n')
+        response_post, session, statement_import = self.upload(path)
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertIn('Line 2 could not be read', job.error)
+        # the failed import is dropped with its file
+        self.assertIsNone(statement_import)
+        self.assertEqual(StagedLine.objects.count(), 0)
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'statements')), [])
+        self.assertContains(self.client.get(response_post.url), 'Line 2 could not be read')
+
+
+    def test_create_payees(self):
+        response_post, session, statement_import = self.upload()
+        client_session = self.client.session
+        client_session['statement_import'] = statement_import.pk
+        client_session.save()
+        response = self.client.get('/accounts/create/payees')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['page_obj']), 6)
+        self.assertEqual([form.initial['name'] for form in response.context['formset']][:2], ['MORRISON STORE LONDON', 'SAINSBURYS LONDON'])
+
+
+class SaveStatementViewTest(TestCase):
+    def setUp(self):
+        modules.clear_payee_cache()
+        self.bank = Account.objects.create(name='BankAccount', type='A', initial_balance=100)
+        self.card = Account.objects.create(name='Creditcard', type='L')
+        category = Category.objects.create(name='Food', type='E')
+        Alias.objects.create(name='MORRISON', category=category)
+        payment = Alias.objects.create(name='CARD PAYMENT')
+        Payee.objects.create(name='MORRISON STORE LONDON', alias=Alias.objects.get(name='MORRISON'))
+        Payee.objects.create(name='PAYMENT RECEIVED', alias=payment)
+        DoubleEntry.objects.create(alias=payment, account_a=self.card, account_b=self.bank)
+
+
+    def stage(self, lines):
+        statement_import = StatementImport.objects.create(account=self.card)
+        for date, payee, amount in lines:
+            StagedLine.objects.create(statement_import=statement_import, date=date, payee=payee, amount=amount)
+        session = self.client.session
+        session['statement_import'] = statement_import.pk
+        session.save()
+        return statement_import
+
+
+    def save(self):
+        # queue the save, run it in the worker and follow the job page
+        response = self.client.post('/accounts/save/statement')
+        modules.run_import_jobs()
+        return self.client.get(response.url)
+
+
+    def test_save_statement(self):
+        self.stage([
+            (datetime.date(2021, 11, 23), 'MORRISON STORE LONDON', Decimal('9.65')),
+            (datetime.date(2021, 11, 29), 'PAYMENT RECEIVED', Decimal('-50')),
+        ])
+        response = self.client.post('/accounts/save/statement')
+        self.assertEqual(response.status_code, 302)
+        # nothing is written in the request
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(self.client.post('/accounts/save/statement').url, response.url)
+        self.assertContains(self.client.get(response.url), 'Queued')
+        modules.run_import_jobs()
+        self.assertEqual(self.client.get(response.url + '?format=json').json(), {'status': 'done', 'lines': 2, 'total': 2, 'error': ''})
+        self.assertEqual(self.client.get(response.url).url, '/accounts/')
+        # both legs of the card payment are saved
+        self.assertEqual(Transaction.objects.count(), 3)
+        self.assertEqual(Transaction.objects.get(account=self.bank).amount, Decimal('-50.00'))
+        self.assertEqual(Transaction.objects.get(account=self.card, alias__name='MORRISON').date, datetime.date(2021, 11, 23))
+        # rollups are kept in step with the bulk insert
+        self.assertEqual(MonthlyRollup.objects.get(account=self.bank).total, Decimal('-50.00'))
+        # the staged lines are gone once saved
+        self.assertEqual(StagedLine.objects.count(), 0)
+        self.assertNotIn('statement_import', self.client.session)
+
+
+    def test_stale_save_job_is_failed(self):
+        self.stage([(datetime.date(2021, 11, 23), 'MORRISON STORE LONDON', Decimal('9.65'))])
+        response = self.client.post('/accounts/save/statement')
+        # a worker claimed the save two hours ago and stopped
+        job = ImportJob.objects.get()
+        two_hours_ago = timezone.now() - datetime.timedelta(hours=2)
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.RUNNING, started=two_hours_ago, updated=two_hours_ago)
+        modules.run_import_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(Transaction.objects.count(), 0)
+        # the staged lines are kept so the save can be queued again
+        retry = self.client.post('/accounts/save/statement')
+        self.assertNotEqual(retry.url, response.url)
+        modules.run_import_jobs()
+        self.assertEqual(Transaction.objects.count(), 1)
+
+
+    def test_slow_job_is_not_failed(self):
+        statement_import = self.stage([(datetime.date(2021, 11, 23), 'MORRISON STORE LONDON', Decimal('9.65'))])
+        # started two hours ago but still reporting progress
+        job = ImportJob.objects.create(statement_import=statement_import, kind=ImportJob.SAVE, status=ImportJob.RUNNING,
+                                       started=timezone.now() - datetime.timedelta(hours=2), updated=timezone.now())
+        self.assertEqual(modules.fail_stale_jobs(), [])
+        # a job failed as left behind is not revived when its worker finishes after all
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.FAILED)
+        modules.run_import_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+
+
+    def test_save_statement_rolls_back(self):
+        statement_import = self.stage([
+            (datetime.date(2021, 11, 23), 'MORRISON STORE LONDON', Decimal('9.65')),
+            (datetime.date(2021, 11, 29), 'PAYMENT RECEIVED', Decimal('-50')),
+        ])
+        modules.resolve_import(statement_import)
+        # a failure after the insert leaves nothing behind
+        with mock.patch.object(modules, 'update_rollups', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                modules.save_import(statement_import)
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(MonthlyRollup.objects.count(), 0)
+        self.assertEqual(StagedLine.objects.count(), 2)
+
+
+    def test_save_statement_new_payees(self):
+        self.stage([(datetime.date(2021, 11, 23), 'UNKNOWN', Decimal('9.65'))])
+        response = self.client.get('/accounts/save/statement')
+        self.assertEqual(response.url, '/accounts/create/payees')
+
+
+    def test_save_statement_removes_existing(self):
+        morrison = Alias.objects.get(name='MORRISON')
+        Transaction.objects.create(date=datetime.date(2021, 11, 23), alias=morrison, amount=9.65, account=self.card)
+        # the same purchase twice on one day, one of them already saved
+        lines = [
+            (datetime.date(2021, 11, 23), 'MORRISON STORE LONDON', Decimal('9.65')),
+            (datetime.date(2021, 11, 23), 'MORRISON STORE LONDON', Decimal('9.65')),
+            (datetime.date(2021, 11, 24), 'MORRISON STORE LONDON', Decimal('9.65')),
+        ]
+        self.stage(lines)
+        response = self.client.get('/accounts/save/statement')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['message'], '1 transactions already existing were removed!')
+        self.assertEqual(len(response.context['page_obj']), 2)
+
+        self.save()
+        self.assertEqual(Transaction.objects.filter(alias=morrison).count(), 3)
+        # uploading the same statement again saves nothing
+        self.stage(lines)
+        self.save()
+        self.assertEqual(Transaction.objects.filter(alias=morrison).count(), 3)
+        self.assertEqual(Transaction.objects.exclude(digest=None).count(), 2)
+
+
+    def test_save_statement_keeps_double_entry_legs_together(self):
+        payment = Alias.objects.get(name='CARD PAYMENT')
+        lines = [(datetime.date(2021, 11, 29), 'PAYMENT RECEIVED', Decimal('-50'))]
+        # a bank transfer of the same amount on the same day does not drop the bank leg of the card payment
+        Transaction.objects.create(date=datetime.date(2021, 11, 29), alias=payment, amount=-50, account=self.bank)
+        self.stage(lines)
+        self.assertEqual(self.client.get('/accounts/save/statement').context['message'], '0 transactions already existing were removed!')
+        self.save()
+        self.assertEqual(Transaction.objects.filter(account=self.card).count(), 1)
+        self.assertEqual(Transaction.objects.filter(account=self.bank).count(), 2)
+        # the card line saved once drops both legs, even after its bank leg was deleted
+        Transaction.objects.filter(account=self.bank).first().delete()
+        self.stage(lines)
+        self.assertEqual(self.client.get('/accounts/save/statement').context['message'], '1 transactions already existing were removed!')
+        self.save()
+        self.assertEqual(Transaction.objects.filter(account=self.card).count(), 1)
+        self.assertEqual(Transaction.objects.filter(account=self.bank).count(), 1)
+
+
+# these measure the rendering, not the page cache
+@override_settings(ACCOUNTS_PAGE_CACHE_SECONDS=0)
+class ListQueryCountTest(TestCase):
+    def setUp(self):
+        bank = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        card = Account.objects.create(name='CreditCard', type='L')
+        food = Category.objects.create(name='Food', type='E')
+        meals = Subcategory.objects.create(name='Meals', category=food)
+        aliases = [Alias.objects.create(name='ALIAS {}'.format(i), category=food, subcategory=meals) for i in range(10)]
+        # 1000 transactions in the balance month
+        Transaction.objects.bulk_create(
+            Transaction(date=datetime.date(2021, 11, 1 + i % 30), alias=aliases[i % 10], amount=-1, account=(bank, card)[i % 2])
+            for i in range(1000)
+        )
+        Payee.objects.bulk_create(Payee(name='PAYEE {}'.format(i), alias=aliases[i % 10]) for i in range(1000))
+        modules.rebuild_rollups()
+
+
+    def assertListQueries(self, url, num):
+        # balance checkpoints are stored on the first visit
+        self.client.get(url)
+        # rendering every row must not add queries
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        return response
+
+
+    def test_account_transactions(self):
+        response = self.assertListQueries('/accounts/1/account', 7)
+        self.assertEqual(len(response.context['transaction_list']), 100)
+
+
+    def test_category_transactions(self):
+        response = self.assertListQueries('/accounts/1/category', 5)
+        self.assertEqual(len(response.context['transaction_list']), 100)
+
+
+    def test_subcategory_transactions(self):
+        response = self.assertListQueries('/accounts/1/subcategory', 5)
+        self.assertEqual(len(response.context['transaction_list']), 100)
+
+
+    def test_alias_transactions(self):
+        response = self.assertListQueries('/accounts/1/alias', 5)
+        self.assertEqual(len(response.context['transaction_list']), 100)
+        self.assertEqual(response.context['next_cursor'], '')
+
+
+    def test_payees(self):
+        response = self.assertListQueries('/accounts/payees', 2)
+        self.assertEqual(len(response.context['payee_list']), 100)
+
+
+    def test_keyset_pages(self):
+        # follow the cursors through every page of the account
+        url, pages, rows = '/accounts/1/account', 0, []
+        while True:
+            response = self.client.get(url)
+            pages += 1
+            rows += list(response.context['transaction_list'])
+            if not response.context['next_cursor']:
+                break
+            url = '/accounts/1/account?after=' + response.context['next_cursor']
+        self.assertEqual(pages, 5)
+        self.assertEqual(len(rows), 500)
+        self.assertEqual(len(set(transaction.pk for transaction in rows)), 500)
+        self.assertEqual([(transaction.date, transaction.pk) for transaction in rows], sorted((transaction.date, transaction.pk) for transaction in rows))
+        # the running balance is carried across the pages
+        self.assertEqual([transaction.balance for transaction in rows], [Decimal(499 - i) for i in range(500)])
+        self.assertEqual(rows[-1].balance, response.context['balance'])
+
+        # the balance is carried in the cursor, a deep page costs the first page's queries and the previous page link
+        self.client.get(url)
+        with self.assertNumQueries(8):
+            response = self.client.get(url)
+        previous = self.client.get('/accounts/1/account?after=' + response.context['previous_cursor'])
+        self.assertEqual(list(previous.context['transaction_list']), rows[300:400])
+        self.assertEqual([transaction.balance for transaction in previous.context['transaction_list']], [Decimal(199 - i) for i in range(100)])
+
+        # a cursor from before a ledger write sums the earlier rows again
+        Transaction.objects.create(date=datetime.date(2021, 11, 1), alias=rows[0].alias, amount=-1, account=rows[0].account)
+        response = self.client.get(url)
+        self.assertEqual(response.context['transaction_list'][0].balance, Decimal(98))
+
+
+    def test_payee_pages(self):
+        response = self.client.get('/accounts/payees?after=' + str(self.client.get('/accounts/payees').context['next_cursor']))
+        self.assertEqual(len(response.context['payee_list']), 100)
+        self.assertEqual(response.context['payee_list'][0].name, 'PAYEE 100')
+        self.assertEqual(response.context['previous_cursor'], '')
+
+
+@override_settings(ACCOUNTS_PAGE_CACHE_SECONDS=0)
+class DashboardQueryCountTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        self.add_categories(0, 1)
+
+
+    def add_categories(self, first, last):
+        for i in range(first, last):
+            category = Category.objects.create(name='Category {}'.format(i), type='E')
+            for j in range(3):
+                subcategory = Subcategory.objects.create(name='Subcategory {} {}'.format(i, j), category=category)
+                alias = Alias.objects.create(name='ALIAS {} {}'.format(i, j), category=category, subcategory=subcategory)
+                Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=alias, amount=-1, account=self.account)
+
+
+    def count_queries(self):
+        self.client.get('/accounts/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/accounts/')
+        return len(queries), response
+
+
+    def test_dashboard_queries_do_not_grow(self):
+        num, response = self.count_queries()
+        self.add_categories(1, 20)
+        self.assertEqual(self.count_queries()[0], num)
+        # every category is followed by its own subcategories
+        num, response = self.count_queries()
+        content = response.content.decode()
+        self.assertLess(content.index('Subcategory 0 2'), content.index('>Category 1<'))
+        self.assertEqual(len(response.context['category_list'][5].subcategories), 3)
+
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        self.alias = Alias.objects.create(name='CHIPOTLE', category=Category.objects.create(name='Food', type='E'))
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+        Parameters.objects.create(date=datetime.date(2021, 11, 30))
+
+
+    def test_pages_served_from_cache(self):
+        for url in ['/accounts/', '/accounts/1/account', '/accounts/1/alias']:
+            first = self.client.get(url)
+            # only the ledger version is read
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.content, first.content)
+        # the history pages also look up their balance date
+        self.client.get('/accounts/history')
+        with self.assertNumQueries(2):
+            self.client.get('/accounts/history')
+
+
+    def test_writes_refresh_pages(self):
+        self.assertContains(self.client.get('/accounts/'), '487.00')
+        Transaction.objects.create(date=datetime.date(2021, 11, 4), alias=self.alias, amount=-7, account=self.account)
+        self.assertContains(self.client.get('/accounts/'), '480.00')
+
+        self.assertContains(self.client.get('/accounts/1/alias'), 'CHIPOTLE')
+        self.alias.name = 'CHIPOTLE GRILL'
+        self.alias.save()
+        self.assertContains(self.client.get('/accounts/1/alias'), 'CHIPOTLE GRILL')
+
+        self.assertEqual(self.client.get('/accounts/history').context['balance_date'], datetime.date(2021, 11, 30))
+        self.client.post('/accounts/select/date', {'date': datetime.date(2021, 10, 31)})
+        self.assertEqual(self.client.get('/accounts/history').context['balance_date'], datetime.date(2021, 10, 31))
+
+
+    def test_file_based_cache(self):
+        with tempfile.TemporaryDirectory() as location:
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}):
+                first = self.client.get('/accounts/')
+                with self.assertNumQueries(1):
+                    self.assertEqual(self.client.get('/accounts/').content, first.content)
+                self.account.initial_balance = 600
+                self.account.save()
+                self.assertContains(self.client.get('/accounts/'), '587.00')
+                cache.clear()
+
+
+class TrendViewTest(TestCase):
+    def setUp(self):
+        account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        alias = Alias.objects.create(name='CHIPOTLE', category=Category.objects.create(name='Food', type='E'))
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=alias, amount=-13, account=account)
+
+
+    def test_trend_defaults_to_last_year(self):
+        response = self.client.get('/accounts/trend')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['trend']['months'][-1], '2021-11')
+        self.assertEqual(len(response.context['trend']['months']), 12)
+
+
+    def test_trend_csv(self):
+        response = self.client.get('/accounts/trend', {'start': '2021-10-01', 'end': '2021-11-30', 'format': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response.content.decode().splitlines(), [
+            'Type,Name,2021-10,2021-11',
+            'Category,Food,0.00,13.00',
+            'Account,BankAccount,0.00,-13.00',
+        ])
+
+
+    def test_trend_json(self):
+        response = self.client.get('/accounts/trend', {'start': '2021-11-01', 'end': '2021-11-30', 'format': 'json'})
+        self.assertEqual(response.json()['categories'], [{'id': Category.objects.get().pk, 'name': 'Food', 'totals': ['13.00']}])
+
+
+    def test_trend_range_limit(self):
+        response = self.client.get('/accounts/trend', {'start': '2011-01-01', 'end': '2021-11-30'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['form'].is_valid())
+        self.assertNotIn('trend', response.context)
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        Account.objects.create(name='CreditCard', type='L', initial_balance=30.50)
+        food = Category.objects.create(name='Food', type='E')
+        meals = Subcategory.objects.create(name='Meals', category=food)
+        self.alias = Alias.objects.create(name='CHIPOTLE', category=food, subcategory=meals)
+        Transaction.objects.create(date=datetime.date(2021, 10, 27), alias=self.alias, amount=-10.50, account=self.account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+
+
+    def test_balances(self):
+        data = self.client.get('/accounts/api/balances').json()
+        self.assertEqual(data['date'], '2021-11-03')
+        self.assertEqual(data['accounts'][0], {'id': self.account.pk, 'name': 'BankAccount', 'type': 'A', 'total': '476.50'})
+        self.assertEqual(data['capital'], '446.00')
+        data = self.client.get('/accounts/api/balances', {'date': '2021-10-31'}).json()
+        self.assertEqual(data['accounts'][0]['total'], '489.50')
+
+
+    def test_report(self):
+        data = self.client.get('/accounts/api/report').json()
+        self.assertEqual(data['expenses'], '13.00')
+        self.assertEqual(data['categories'][0]['subcategories'], [{'id': self.alias.subcategory_id, 'name': 'Meals', 'total': '13.00'}])
+        self.assertEqual(data['categories'][0]['aliases'][0]['name'], 'CHIPOTLE')
+
+
+    def test_transactions(self):
+        data = self.client.get('/accounts/api/{}/account'.format(self.account.pk)).json()
+        self.assertEqual(data['balance'], '476.50')
+        self.assertEqual(data['transactions'], [
+            {'id': Transaction.objects.get(amount=-13).pk, 'date': '2021-11-03', 'account': self.account.pk, 'alias': 'CHIPOTLE', 'amount': '-13.00', 'balance': '476.50'},
+        ])
+        data = self.client.get('/accounts/api/{}/alias'.format(self.alias.pk), {'date': '2021-10-31'}).json()
+        self.assertEqual(data['total'], '10.50')
+        self.assertEqual(len(data['transactions']), 1)
+
+
+    def test_bad_date(self):
+        response = self.client.get('/accounts/api/balances', {'date': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('date', response.json()['errors'])
+
+
+    def test_conditional_get(self):
+        response = self.client.get('/accounts/api/balances')
+        etag = response['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        with self.assertNumQueries(1):
+            response = self.client.get('/accounts/api/balances', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # any write changes the tag
+        Transaction.objects.create(date=datetime.date(2021, 11, 4), alias=self.alias, amount=-7, account=self.account)
+        response = self.client.get('/accounts/api/balances', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['accounts'][0]['total'], '469.50')
+
+
+@override_settings(ACCOUNTS_PAGE_CACHE_SECONDS=0, ACCOUNTS_PROFILING_SAMPLE_RATE=1)
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        food = Category.objects.create(name='Food', type='E')
+        Category.objects.create(name='Travel', type='E')
+        self.alias = Alias.objects.create(name='CHIPOTLE', category=food)
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+        Parameters.objects.create(date=datetime.date(2021, 11, 30))
+
+
+    def metrics(self, response):
+        return {metric.split(';')[0]: metric for metric in response['Server-Timing'].split(', ')}
+
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/accounts/{}/account'.format(self.account.pk))
+        metrics = self.metrics(response)
+        self.assertIn('desc="{} queries"'.format(len(queries)), metrics['sql'])
+        for name in ['total', 'view', 'template', 'transactions', 'totals']:
+            self.assertIn(name + ';dur=', metrics[name])
+
+        self.assertIn('balances', self.metrics(self.client.get('/accounts/')))
+        with override_settings(ACCOUNTS_PROFILING_SAMPLE_RATE=0):
+            self.assertNotIn('Server-Timing', self.client.get('/accounts/'))
+
+
+    def test_json_log(self):
+        with override_settings(ACCOUNTS_PROFILING_LOG=True), self.assertLogs('accounts.profiling', 'INFO') as logs:
+            self.client.get('/accounts/')
+        summary = json.loads(logs.records[0].getMessage())
+        self.assertEqual(summary['view'], 'accounts:index')
+        self.assertEqual(summary['status'], 200)
+        self.assertGreater(summary['queries'], 0)
+        self.assertIn('report', summary['spans'])
+
+
+    def test_repeated_queries(self):
+        self.assertEqual(profiling.fingerprint("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'it''s'"), 'SELECT * FROM t WHERE id IN (?) AND name = ?')
+        # one query per category is reported as a repeated query
+        token = profiling.PROFILE.set(profiling.start_profile())
+        try:
+            for category in Category.objects.all():
+                modules.sum_category(category, datetime.date(2021, 11, 30))
+            profile = profiling.PROFILE.get()
+        finally:
+            profiling.PROFILE.reset(token)
+        summary = profiling.get_summary(RequestFactory().get('/'), views.HttpResponse(), profile)
+        self.assertEqual(summary['queries'], 3)
+        self.assertEqual(summary['duplicates'][0]['count'], 2)
+        self.assertIn('sql-repeats;desc="1 repeated queries"', profiling.server_timing(summary))
+
+
+# the async views read from worker threads with their own connections, so the data must be committed
+@override_settings(ACCOUNTS_PAGE_CACHE_SECONDS=0)
+class AsyncViewsTest(TransactionTestCase):
+    # the history pages read Parameters pk=1
+    reset_sequences = True
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.account = Account.objects.create(name='BankAccount', type='A', initial_balance=500)
+        Account.objects.create(name='CreditCard', type='L', initial_balance=30.50)
+        food = Category.objects.create(name='Food', type='E')
+        self.alias = Alias.objects.create(name='CHIPOTLE', category=food, subcategory=Subcategory.objects.create(name='Meals', category=food))
+        Transaction.objects.create(date=datetime.date(2021, 10, 27), alias=self.alias, amount=-10.50, account=self.account)
+        Transaction.objects.create(date=datetime.date(2021, 11, 3), alias=self.alias, amount=-13, account=self.account)
+        Parameters.objects.create(date=datetime.date(2021, 10, 31))
+
+
+    def get(self, view, url, **kwargs):
+        return async_to_sync(view)(self.factory.get(url), **kwargs)
+
+
+    def test_dashboard_matches_sync_view(self):
+        for url, template_name in [('/accounts/', 'accounts/index.html'), ('/accounts/history', 'accounts/history.html')]:
+            response = self.get(async_views.dashboard, url, template_name=template_name)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, self.client.get(url).content)
+
+
+    def test_transaction_list_matches_sync_view(self):
+        # the sync view stores the checkpoints first, the in-memory test database
+        # fails concurrent writers instead of making them wait
+        url = '/accounts/{}/account'.format(self.account.pk)
+        expected = self.client.get(url).content
+        response = self.get(async_views.transaction_list, url, pk=self.account.pk, view_class=views.AccountView, template_name='accounts/transactions.html')
+        self.assertEqual(response.content, expected)
+        url = '/accounts/history/{}/alias'.format(self.alias.pk)
+        expected = self.client.get(url).content
+        response = self.get(async_views.transaction_list, url, pk=self.alias.pk, view_class=views.AliasView, template_name='accounts/transactions_history.html')
+        self.assertEqual(response.content, expected)
+
+
+    def test_api(self):
+        response = self.get(async_views.api_balances, '/accounts/api/balances')
+        self.assertEqual(response.content, self.client.get('/accounts/api/balances').content)
+        self.assertEqual(response['ETag'], self.client.get('/accounts/api/balances')['ETag'])
+        response = self.get(async_views.api_report, '/accounts/api/report?date=2021-10-31')
+        self.assertEqual(response.content, self.client.get('/accounts/api/report?date=2021-10-31').content)
+        url = '/accounts/api/{}/alias'.format(self.alias.pk)
+        response = self.get(async_views.api_transaction_list, url, pk=self.alias.pk, view_class=views.AliasView)
+        self.assertEqual(response.content, self.client.get(url).content)
+
+        request = self.factory.get('/accounts/api/balances', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(async_to_sync(async_views.api_balances)(request).status_code, 304)
+        self.assertEqual(self.get(async_views.api_balances, '/accounts/api/balances?date=never').status_code, 400)
+
+
+    def test_aggregations_run_concurrently(self):
+        # the balances and the report wait for each other, they only finish if both run at once
+        barrier = threading.Barrier(2, timeout=5)
+        def wait(context):
+            def wrapper(balance_date):
+                barrier.wait()
+                return context(balance_date)
+            return wrapper
+        with mock.patch.object(async_views, 'get_balance_context', wait(views.get_balance_context)), \
+                mock.patch.object(async_views, 'get_report_context', wait(views.get_report_context)):
+            response = self.get(async_views.dashboard, '/accounts/', template_name='accounts/index.html')
+        self.assertEqual(response.status_code, 200)
+
+
+    @override_settings(ACCOUNTS_PAGE_CACHE_SECONDS=0, ACCOUNTS_PROFILING_SAMPLE_RATE=1)
+    def test_profiling(self):
+        # queries run in the worker threads are counted for the request
+        async def dashboard(request):
+            return await async_views.dashboard(request, template_name='accounts/index.html')
+        middleware = profiling.ProfilingMiddleware(dashboard)
+        response = async_to_sync(middleware)(self.factory.get('/accounts/'))
+        metrics = response['Server-Timing']
+        self.assertNotIn('desc="0 queries"', metrics)
+        for name in ['balances;dur=', 'report;dur=', 'template;dur=']:
+            self.assertIn(name, metrics)
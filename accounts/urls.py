@@ -1,7 +1,16 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, async_views, views
 
 app_name = 'accounts'
+
+REPORTING_VIEWS = {
+    'index', 'history',
+    'account_transactions', 'account_history', 'category_transactions', 'category_history',
+    'subcategory_transactions', 'subcategory_history', 'alias_transactions', 'alias_history',
+    'api_balances', 'api_report',
+    'api_account_transactions', 'api_category_transactions', 'api_subcategory_transactions', 'api_alias_transactions',
+}
 urlpatterns = [
     path('', views.IndexView.as_view(template_name='accounts/index.html'), name='index'),
     path('history', views.IndexView.as_view(template_name='accounts/history.html'), name='history'),
@@ -16,8 +25,39 @@ urlpatterns = [
     path('upload/statement', views.upload_statement, name='upload_statement'),
     path('create/payees', views.create_payees, name='create_payees'),
     path('save/statement', views.save_statement, name='save_statement'),
+    path('import/<int:pk>', views.import_job, name='import_job'),
+    path('upload/statements', views.upload_statements, name='upload_statements'),
+    path('import/jobs', views.import_jobs, name='import_jobs'),
     path('select/date', views.select_date, name='select_date'),
+    path('trend', views.trend, name='trend'),
     path('create/alias', views.create_alias, name='create_alias'),
     path('double/entry', views.double_entry, name='double_entry'),
     path('payees', views.PayeeView.as_view(), name='payees'),
+    path('api/balances', api.BalancesApiView.as_view(), name='api_balances'),
+    path('api/report', api.ReportApiView.as_view(), name='api_report'),
+    path('api/<int:pk>/account', api.AccountApiView.as_view(), name='api_account_transactions'),
+    path('api/<int:pk>/category', api.CategoryApiView.as_view(), name='api_category_transactions'),
+    path('api/<int:pk>/subcategory', api.SubcategoryApiView.as_view(), name='api_subcategory_transactions'),
+    path('api/<int:pk>/alias', api.AliasApiView.as_view(), name='api_alias_transactions'),
 ]
+
+if settings.ACCOUNTS_ASYNC_VIEWS:
+    # the read-only reporting views run their aggregations concurrently under ASGI
+    urlpatterns = [
+        path('', async_views.dashboard, {'template_name': 'accounts/index.html'}, name='index'),
+        path('history', async_views.dashboard, {'template_name': 'accounts/history.html'}, name='history'),
+        path('<int:pk>/account', async_views.transaction_list, {'view_class': views.AccountView, 'template_name': 'accounts/transactions.html'}, name='account_transactions'),
+        path('history/<int:pk>/account', async_views.transaction_list, {'view_class': views.AccountView, 'template_name': 'accounts/transactions_history.html'}, name='account_history'),
+        path('<int:pk>/category', async_views.transaction_list, {'view_class': views.CategoryView, 'template_name': 'accounts/transactions.html'}, name='category_transactions'),
+        path('history/<int:pk>/category', async_views.transaction_list, {'view_class': views.CategoryView, 'template_name': 'accounts/transactions_history.html'}, name='category_history'),
+        path('<int:pk>/subcategory', async_views.transaction_list, {'view_class': views.SubcategoryView, 'template_name': 'accounts/transactions.html'}, name='subcategory_transactions'),
+        path('history/<int:pk>/subcategory', async_views.transaction_list, {'view_class': views.SubcategoryView, 'template_name': 'accounts/transactions_history.html'}, name='subcategory_history'),
+        path('<int:pk>/alias', async_views.transaction_list, {'view_class': views.AliasView, 'template_name': 'accounts/transactions.html'}, name='alias_transactions'),
+        path('history/<int:pk>/alias', async_views.transaction_list, {'view_class': views.AliasView, 'template_name': 'accounts/transactions_history.html'}, name='alias_history'),
+        path('api/balances', async_views.api_balances, name='api_balances'),
+        path('api/report', async_views.api_report, name='api_report'),
+        path('api/<int:pk>/account', async_views.api_transaction_list, {'view_class': views.AccountView}, name='api_account_transactions'),
+        path('api/<int:pk>/category', async_views.api_transaction_list, {'view_class': views.CategoryView}, name='api_category_transactions'),
+        path('api/<int:pk>/subcategory', async_views.api_transaction_list, {'view_class': views.SubcategoryView}, name='api_subcategory_transactions'),
+        path('api/<int:pk>/alias', async_views.api_transaction_list, {'view_class': views.AliasView}, name='api_alias_transactions'),
+    ] + [pattern for pattern in urlpatterns if pattern.name not in REPORTING_VIEWS]
@@ -1,132 +1,234 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import F, Q, Sum
 from django.forms.formsets import formset_factory
 from django.views.generic import ListView
-from django.http import HttpResponseRedirect
-from django.shortcuts import render
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
-import datetime
 from decimal import Decimal
+import csv
+import datetime
 
-from .models import DoubleEntry, Parameters, Transaction, Account, Payee, Alias, Category, Subcategory
-from .forms import UploadFileForm, AliasForm, PayeeForm, DateForm, DoubleEntryForm
-from . import modules
+from .models import Parameters, Transaction, Account, Payee, Alias, Category, Subcategory, StatementImport, ImportJob
+from .forms import UploadFileForm, AliasForm, PayeeForm, DateForm, DoubleEntryForm, TrendForm
+from . import analytics, modules, profiling
                 
     
-class IndexView(ListView):
+def with_related(transactions):
+    # load everything transactions.html shows along with the rows
+    return transactions.select_related('account', 'alias__category', 'alias__subcategory')
+
+
+def get_ledger_head(request):
+    # the version is a database read, a request reads it once
+    if not hasattr(request, 'ledger_head'):
+        request.ledger_head = modules.get_ledger_head()
+    return request.ledger_head
+
+
+def page_cache_key(request, balance_date):
+    return 'accounts:page:{}:{}:{}'.format(get_ledger_head(request)['version'], balance_date.isoformat(), request.get_full_path())
+
+
+class LedgerCacheMixin:
+    # whole pages are cached per ledger version and balance date, any ledger write moves every key on
+
+    def get(self, request, *args, **kwargs):
+        timeout = settings.ACCOUNTS_PAGE_CACHE_SECONDS
+        if not timeout:
+            return super().get(request, *args, **kwargs)
+        key = page_cache_key(request, self.get_balance_date())
+        response = cache.get(key)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+            if hasattr(response, 'add_post_render_callback'):
+                response.add_post_render_callback(lambda response: cache.set(key, response, timeout))
+            elif response.status_code == 200:
+                cache.set(key, response, timeout)
+        return response
+
+
+def get_balance_context(balance_date):
+    # Calculate balance summary at balance_date and at the end of the previous month
+    prev_date = datetime.date(balance_date.year, balance_date.month, 1) - datetime.timedelta(days=1)
+    with profiling.timed('balances'):
+        account_list = modules.add_account_totals(balance_date, prev_date)
+    assets, liabilities = modules.get_balance_summary(account_list)
+
+    # Calculate profit comparing with previous balance
+    prev_assets, prev_liabilities = modules.get_balance_summary(account_list, 1)
+    return {
+        'account_list': account_list,
+        'assets': assets,
+        'liabilities': liabilities,
+        'capital': assets - liabilities,
+        'balance_profit': (assets - liabilities) - (prev_assets - prev_liabilities),
+    }
+
+
+def get_report_context(balance_date):
+    # Calculate category totals, subcategory totals come from the same report
+    with profiling.timed('report'):
+        category_list, income, expenses = modules.get_expenses_report(balance_date)
+    return {
+        'category_list': category_list,
+        'income': income,
+        'expenses': expenses,
+        'profit': income - expenses,
+        'subcategory_list': modules.get_subcategory_list(category_list),
+    }
+
+
+class IndexView(LedgerCacheMixin, ListView):
     model = Account
-    
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
 
+    def get_balance_date(self):
         # Check if called from index or history path
         if self.template_name == 'accounts/index.html':
-            balance_date = Transaction.objects.all().order_by('-date').first().date
-        else:
-            balance_date = Parameters.objects.get(pk=1).date
-        
-        # Calculate balance summary
-        account_list = modules.add_account_totals(balance_date)
-        assets, liabilities = modules.get_balance_summary(account_list)
+            return get_ledger_head(self.request)['date']
+        return Parameters.objects.get(pk=1).date
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        balance_date = self.get_balance_date()
         context['balance_date'] = balance_date
-        context['account_list'] = account_list
-        context['assets'] = assets
-        context['liabilities'] = liabilities
-        context['capital'] = assets - liabilities
-
-        # Calculate profit comparing with previous balance
-        prev_date = datetime.date(balance_date.year, balance_date.month, 1) - datetime.timedelta(days=1)
-        prev_account_list = modules.add_account_totals(prev_date)
-        prev_assets, prev_liabilities = modules.get_balance_summary(prev_account_list)
-        context['balance_profit'] = (assets - liabilities) - (prev_assets - prev_liabilities)
-               
-        # Calculate category totals
-        category_list, income, expenses = modules.get_expenses_report(balance_date)
-        context['category_list'] = category_list
-        context['income'] = income
-        context['expenses'] = expenses
-        context['profit'] = income - expenses
-                
-        # Calculate subcategory totals              
-        context['subcategory_list'] = modules.add_subcategory_totals(balance_date)
-        
+        context.update(get_balance_context(balance_date))
+        context.update(get_report_context(balance_date))
         return context
 
     
-class AccountView(ListView):
+TRANSACTIONS_PER_PAGE = 100
+
+
+def parse_cursor(value):
+    # a cursor is the '<date>.<id>' of the last row of the previous page followed by the
+    # '.<balance in cents>.<ledger version>' of the running balance at that row
+    try:
+        fields = value.split('.')
+        cursor = datetime.date.fromisoformat(fields[0]), int(fields[1])
+        if len(fields) == 2:
+            return cursor + (None, None)
+        if len(fields) == 4:
+            return cursor + (Decimal(int(fields[2])).scaleb(-2), int(fields[3]))
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+
+def format_cursor(date, pk, balance, version):
+    return '{}.{}.{}.{}'.format(date.isoformat(), pk, int(balance * 100), version)
+
+
+def after_cursor(cursor):
+    date, pk = cursor[:2]
+    return Q(date__gt=date) | Q(date=date, pk__gt=pk)
+
+
+class TransactionListView(LedgerCacheMixin, ListView):
     model = Transaction
-    
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
 
-        # Check if called from account_transactions or account_history path
+    def get_balance_date(self):
+        # Check if called from the transactions or the history path
         if self.template_name == 'accounts/transactions.html':
-            balance_date = Transaction.objects.all().order_by('-date').first().date
-        else:
-            balance_date = Parameters.objects.get(pk=1).date
+            return get_ledger_head(self.request)['date']
+        return Parameters.objects.get(pk=1).date
 
-        account = Account.objects.get(pk=self.kwargs['pk'])
-        context['balance_date'] = balance_date
-        context['transaction_list'] = Transaction.objects.filter(account=account, date__month=balance_date.month)
-        context['balance'] = modules.sum_account(account, balance_date)
-        context['is_account'] = True      
-        return context
-    
-    
-class CategoryView(ListView):
-    model = Transaction
-    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        balance_date = self.get_balance_date()
+        entity = self.get_entity()
+        context['balance_date'] = balance_date
+        with profiling.timed('transactions'):
+            context.update(self.get_transactions(entity, balance_date))
+        with profiling.timed('totals'):
+            context.update(self.get_totals(entity, balance_date))
+        return context
 
-        # Check if called from category_transactions or category_history path
-        if self.template_name == 'accounts/transactions.html':
-            balance_date = Transaction.objects.all().order_by('-date').first().date
-        else:
-            balance_date = Parameters.objects.get(pk=1).date
+    def get_page(self, transactions, opening, signed=F('amount')):
+        # keyset pagination on (date, id), every page costs the same however deep it is
+        transactions = with_related(transactions).annotate(signed=signed).order_by('date', 'pk')
+        cursor = parse_cursor(self.request.GET.get('after'))
+        version = get_ledger_head(self.request)['version']
+        page = transactions
+        context = {'has_previous': False, 'previous_cursor': '', 'next_cursor': ''}
+        if cursor:
+            page = transactions.filter(after_cursor(cursor))
+            earlier = transactions.exclude(after_cursor(cursor))
+            if cursor[3] == version:
+                # the running balance is carried over from the previous page while the ledger is unchanged
+                opening = cursor[2]
+            else:
+                opening += earlier.aggregate(total=Sum('signed'))['total'] or 0
+            context['has_previous'] = True
+            # the previous page starts after the row a page back, its balance is taken back from this opening
+            previous = list(earlier.order_by('-date', '-pk').values_list('date', 'pk', 'signed')[:TRANSACTIONS_PER_PAGE + 1])
+            if len(previous) > TRANSACTIONS_PER_PAGE:
+                date, pk = previous.pop()[:2]
+                context['previous_cursor'] = format_cursor(date, pk, opening - sum(row[2] for row in previous), version)
+        page = page[:TRANSACTIONS_PER_PAGE]
 
-        category = Category.objects.get(pk=self.kwargs['pk'])
-        context['balance_date'] = balance_date
-        context['transaction_list'] = Transaction.objects.filter(alias__category=category, date__month=balance_date.month)
-        context['total'] = modules.sum_category(category, balance_date)
+        balance = opening
+        for transaction in page:
+            balance += transaction.signed
+            transaction.balance = balance
+            last = transaction
+        if len(page) == TRANSACTIONS_PER_PAGE and transactions.filter(after_cursor((last.date, last.pk))).exists():
+            context['next_cursor'] = format_cursor(last.date, last.pk, last.balance, version)
+        context['transaction_list'] = page
         return context
+
     
+class AccountView(TransactionListView):
+
+    def get_entity(self):
+        return Account.objects.get(pk=self.kwargs['pk'])
+
+    def get_transactions(self, account, balance_date):
+        # the running balance starts from the previous month end
+        checkpoint_date = modules.month_end(balance_date)
+        opening = modules.get_checkpoints([checkpoint_date], [account])[(account.pk, checkpoint_date)]
+        return self.get_page(Transaction.objects.filter(account=account, date__range=modules.month_range(balance_date)), opening)
+
+    def get_totals(self, account, balance_date):
+        return {'balance': modules.sum_account(account, balance_date), 'is_account': True}
     
-class SubcategoryView(ListView):
-    model = Transaction
     
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+class CategoryView(TransactionListView):
 
-        # Check if called from subcategory_transactions or subcategory_history path
-        if self.template_name == 'accounts/transactions.html':
-            balance_date = Transaction.objects.all().order_by('-date').first().date
-        else:
-            balance_date = Parameters.objects.get(pk=1).date
-        
-        subcategory = Subcategory.objects.get(pk=self.kwargs['pk'])
-        context['balance_date'] = balance_date
-        context['transaction_list'] = Transaction.objects.filter(alias__subcategory=subcategory, date__month=balance_date.month)
-        context['total'] = modules.sum_subcategory(subcategory, balance_date)
-        return context
+    def get_entity(self):
+        return Category.objects.get(pk=self.kwargs['pk'])
+
+    def get_transactions(self, category, balance_date):
+        return self.get_page(Transaction.objects.filter(alias__category=category, date__range=modules.month_range(balance_date)), 0, modules.signed_amount())
+
+    def get_totals(self, category, balance_date):
+        return {'total': modules.sum_category(category, balance_date)}
     
     
-class AliasView(ListView):
-    model = Transaction
+class SubcategoryView(TransactionListView):
+
+    def get_entity(self):
+        return Subcategory.objects.get(pk=self.kwargs['pk'])
+
+    def get_transactions(self, subcategory, balance_date):
+        return self.get_page(Transaction.objects.filter(alias__subcategory=subcategory, date__range=modules.month_range(balance_date)), 0, modules.signed_amount())
+
+    def get_totals(self, subcategory, balance_date):
+        return {'total': modules.sum_subcategory(subcategory, balance_date)}
     
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    
+class AliasView(TransactionListView):
 
-        # Check if called from subcategory_transactions or subcategory_history path
-        if self.template_name == 'accounts/transactions.html':
-            balance_date = Transaction.objects.all().order_by('-date').first().date
-        else:
-            balance_date = Parameters.objects.get(pk=1).date
+    def get_entity(self):
+        return Alias.objects.select_related('category').get(pk=self.kwargs['pk'])
 
-        alias = Alias.objects.get(pk=self.kwargs['pk'])
-        context['balance_date'] = balance_date
-        context['transaction_list'] = Transaction.objects.filter(alias=alias, date__month=balance_date.month)
-        context['total'] = modules.sum_alias(alias, balance_date)
-        context['has_category'] = alias.category
-        return context
+    def get_transactions(self, alias, balance_date):
+        return self.get_page(Transaction.objects.filter(alias=alias, date__range=modules.month_range(balance_date)), 0, modules.signed_amount())
+
+    def get_totals(self, alias, balance_date):
+        return {'total': modules.sum_alias(alias, balance_date), 'has_category': alias.category}
 
 
 def select_date(request):
@@ -145,30 +247,87 @@ def select_date(request):
         form = DateForm()
     return render(request, 'accounts/balance_date.html', { 'form': form })
 
+
+def trend(request):
+    # the last twelve months up to the latest transaction unless a range is given
+    if 'start' in request.GET:
+        form = TrendForm(request.GET)
+    else:
+        end = get_ledger_head(request)['date']
+        form = TrendForm({'start': modules.add_months(end, -11), 'end': end})
+    context = {'form': form}
+    if form.is_valid():
+        engine = analytics if analytics.enabled() else modules
+        trend = engine.get_trend(form.cleaned_data['start'], form.cleaned_data['end'])
+        if form.cleaned_data['format'] == 'csv':
+            response = HttpResponse(content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="trend.csv"'
+            csv.writer(response).writerows(modules.trend_rows(trend))
+            return response
+        if form.cleaned_data['format'] == 'json':
+            return JsonResponse(trend)
+        context['trend'] = trend
+    return render(request, 'accounts/trend.html', context)
+
     
+# the upload steps keep only the import id in the session and page through its staged lines
+LINES_PER_PAGE = 50
+
+
+def get_statement_import(request):
+    return get_object_or_404(StatementImport.objects.select_related('account'), pk=request.session.get('statement_import'))
+
+
+def get_lines_page(request, statement_import, lines=None):
+    if lines is None:
+        lines = statement_import.stagedline_set.all()
+    lines = lines.select_related('statement_import__account', 'alias__category', 'alias__subcategory').order_by('pk')
+    return Paginator(lines, LINES_PER_PAGE).get_page(request.GET.get('page'))
+
+
 # file upload
 def upload_statement(request):
     if request.method == 'POST':
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
-            transaction_list = modules.read_statement(request.FILES['statement'], request.POST['account'])
-            transaction_list_updated, new_payees = modules.assign_alias(transaction_list)
-            request.session['transaction_list'] = transaction_list_updated
-            # choose the next view
-            if new_payees != []:
-                request.session['new_payees'] = new_payees
-                return HttpResponseRedirect(reverse('accounts:create_payees'))
-            else:
-                return HttpResponseRedirect(reverse('accounts:save_statement'))
+            # drop an unfinished upload
+            StatementImport.objects.filter(pk=request.session.get('statement_import')).delete()
+            # the import worker reads the file, the request only stores it
+            statement_import = StatementImport.objects.create(account=form.cleaned_data['account'], statement=request.FILES['statement'])
+            job = ImportJob.objects.create(statement_import=statement_import, kind=ImportJob.STAGE)
+            request.session['statement_import'] = statement_import.pk
+            return HttpResponseRedirect(reverse('accounts:import_job', args=[job.pk]))
     else:
         form = UploadFileForm()
     return render(request, 'accounts/upload.html', { 'form': form })
     
 
+UPLOAD_FORMS = 6
+
+
+# several statements at once, parsed in parallel by the import worker and saved together
+def upload_statements(request):
+    UploadFileFormSet = formset_factory(UploadFileForm, extra=UPLOAD_FORMS)
+    if request.method == 'POST':
+        formset = UploadFileFormSet(request.POST, request.FILES)
+        if formset.is_valid():
+            jobs = []
+            for form in formset:
+                if not form.has_changed():
+                    continue
+                statement = form.cleaned_data['statement']
+                statement_import = StatementImport.objects.create(account=form.cleaned_data['account'], statement=statement)
+                jobs.append(ImportJob.objects.create(statement_import=statement_import, kind=ImportJob.IMPORT, name=statement.name[:100]))
+            request.session['import_jobs'] = [job.pk for job in jobs]
+            return HttpResponseRedirect(reverse('accounts:import_jobs'))
+    else:
+        formset = UploadFileFormSet()
+    return render(request, 'accounts/upload_statements.html', { 'formset': formset })
+
+
 # display transactions to assign alias to new payees or create new aliases
 def create_payees(request):
-    transaction_list = request.session['transaction_list']
-    new_payees = request.session['new_payees']
+    statement_import = get_statement_import(request)
     PayeeFormSet = formset_factory(PayeeForm, extra=0)
     
     if request.method == 'POST':
@@ -177,19 +336,23 @@ def create_payees(request):
             # save data
             for form in formset:
                 form.save()
+            # ask for the next payees if there are more than fit in one formset
+            if modules.resolve_import(statement_import) != []:
+                return HttpResponseRedirect(reverse('accounts:create_payees'))
             return HttpResponseRedirect(reverse('accounts:save_statement'))
     else:
+        new_payees = modules.get_new_payees(statement_import, limit=LINES_PER_PAGE)
         formset = PayeeFormSet(initial=[{'name': payee } for payee in new_payees])
     
     context = { 
-        'transaction_list': transaction_list, 
+        'page_obj': get_lines_page(request, statement_import),
         'formset': formset
     }
     return render(request, 'accounts/payees.html', context)
 
 
 def create_alias(request):
-    transaction_list = request.session['transaction_list']
+    statement_import = get_statement_import(request)
 
     if request.method == 'POST':
         form = AliasForm(request.POST)
@@ -205,7 +368,7 @@ def create_alias(request):
         form = AliasForm()
     
     context = {
-        'transaction_list': transaction_list,
+        'page_obj': get_lines_page(request, statement_import),
         'form': form
     }
     return render(request, 'accounts/alias.html', context)
@@ -213,7 +376,7 @@ def create_alias(request):
 
 #create double entry for new alias
 def double_entry(request):
-    transaction_list = request.session['transaction_list']
+    statement_import = get_statement_import(request)
 
     if request.method == 'POST':
         form = DoubleEntryForm(request.POST)
@@ -222,76 +385,87 @@ def double_entry(request):
             return HttpResponseRedirect(reverse('accounts:create_payees'))
     else:
         alias = Alias.objects.last()
-        account_a = Account.objects.get(name=transaction_list[0][0])
-        form = DoubleEntryForm(initial={ 'alias': alias, 'account_a': account_a })
+        form = DoubleEntryForm(initial={ 'alias': alias, 'account_a': statement_import.account })
 
     context = {
-        'transaction_list': transaction_list,
+        'page_obj': get_lines_page(request, statement_import),
         'form': form
     }
     return render(request, 'accounts/double_entry.html', context )
 
 
 def save_statement(request):
-    transaction_list = request.session['transaction_list']
-    transaction_list_updated, new_payees = modules.assign_alias(transaction_list)
+    statement_import = get_statement_import(request)
+    if modules.resolve_import(statement_import) != []:
+        return HttpResponseRedirect(reverse('accounts:create_payees'))
 
     if request.method == 'POST':
-        # save data
-        for transaction in transaction_list_updated:
-            # format date
-            date_list = transaction[1].split('/')
-            if date_list[0] != 4:
-                date = date_list[2] + '-' + date_list[1] + '-' + date_list[0]
-            else:
-                date = date_list[0] + '-' + date_list[1] + '-' + date_list[2]
-            
-            alias = Alias.objects.get(name=transaction[2])
-            account = Account.objects.get(name=transaction[0])
-            
-            # save transaction
-            full_transaction = Transaction(date=date, alias=alias, amount=transaction[5], account=account)
-            full_transaction.save()
-
-            # save double_entry if required
-            try:
-                account_b = DoubleEntry.objects.get(alias=alias).account_b
-                double_transaction = Transaction(date=date, alias=alias, amount=transaction[5], account=account_b)
-                if account.type == account_b.type:
-                    double_transaction.amount = -Decimal(double_transaction.amount)
-                double_transaction.save()
-            except DoubleEntry.DoesNotExist:
-                pass
+        # the worker saves both legs of every transaction in a single atomic write
+        job = statement_import.importjob_set.filter(kind=ImportJob.SAVE).exclude(status=ImportJob.FAILED).first()
+        if job is None:
+            job = ImportJob.objects.create(statement_import=statement_import, kind=ImportJob.SAVE)
+        return HttpResponseRedirect(reverse('accounts:import_job', args=[job.pk]))
+    else:
+        # if request.method is GET show the statement without the existing transactions,
+        # the full statement is matched again when saving
+        if 'page' not in request.GET:
+            modules.mark_duplicates(statement_import)
+        count = statement_import.stagedline_set.filter(duplicate=True).count()
+        message = str(count) + ' transactions already existing were removed!'
+        context = {
+            'page_obj': get_lines_page(request, statement_import, statement_import.stagedline_set.filter(duplicate=False)),
+            'message': message
+        }
+        return render(request, 'accounts/statement.html', context)
+
 
+def import_job(request, pk):
+    job = get_object_or_404(ImportJob, pk=pk)
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'status': job.status, 'lines': job.lines, 'total': job.total, 'error': job.error})
+    # a finished job moves on to the next step of the upload
+    if job.status == ImportJob.DONE:
+        if job.kind == ImportJob.STAGE:
+            return HttpResponseRedirect(reverse('accounts:save_statement'))
+        request.session.pop('statement_import', None)
         return HttpResponseRedirect(reverse('accounts:index'))
-    else:
-        # if request.method is GET remove exisitng transactions before sending POST for saving
-        new_transaction_list = []
-        count = 0
-        for transaction in transaction_list_updated:
-            # format date
-            date_list = transaction[1].split('/')
-            if date_list[0] != 4:
-                date = date_list[2] + '-' + date_list[1] + '-' + date_list[0]
-            else:
-                date = date_list[0] + '-' + date_list[1] + '-' + date_list[2]
-            
-            alias = Alias.objects.get(name=transaction[2])
-            account = Account.objects.get(name=transaction[0])
-            
-            # check if transaction exists to be removed from the list
-            exists = Transaction.objects.get(date=date, alias=alias, amount=transaction[5], account=account)
-            if exists:
-                count += 1
-            else:
-                new_transaction_list.add(transaction)
+    return render(request, 'accounts/import_job.html', { 'job': job })
 
-        request.session['transaction_list'] = new_transaction_list
-        message = str(count) + ' transactions already existing were removed!'
-        return render(request, 'accounts/statement.html', { 'transaction_list': new_transaction_list, 'message': message })
+
+def import_jobs(request):
+    jobs = ImportJob.objects.filter(pk__in=request.session.get('import_jobs', [])).order_by('pk')
+    context = {
+        'jobs': jobs,
+        'running': any(not job.finished_running for job in jobs),
+    }
+    return render(request, 'accounts/import_jobs.html', context)
+
+
+PAYEES_PER_PAGE = 100
 
 
 class PayeeView(ListView):
-    model = Payee
     template_name = 'accounts/payees_list.html'
 
+    def get_queryset(self):
+        # keyset pagination on the payee id
+        self.payees = Payee.objects.select_related('alias__category', 'alias__subcategory').order_by('pk')
+        after = self.request.GET.get('after', '')
+        self.cursor = int(after) if after.isdigit() else None
+        if self.cursor:
+            return self.payees.filter(pk__gt=self.cursor)[:PAYEES_PER_PAGE]
+        return self.payees[:PAYEES_PER_PAGE]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        payee_list = list(context['payee_list'])
+        context['has_previous'] = self.cursor is not None
+        context['previous_cursor'] = ''
+        context['next_cursor'] = ''
+        if self.cursor:
+            for payee in self.payees.filter(pk__lte=self.cursor).order_by('-pk')[PAYEES_PER_PAGE:PAYEES_PER_PAGE + 1]:
+                context['previous_cursor'] = payee.pk
+        if len(payee_list) == PAYEES_PER_PAGE and self.payees.filter(pk__gt=payee_list[-1].pk).exists():
+            context['next_cursor'] = payee_list[-1].pk
+        return context
+
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 from pathlib import Path
+import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -41,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'accounts.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +84,52 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'accounts',
+    }
+}
+
+# Dashboard and transaction pages are cached per ledger version, 0 turns it off
+ACCOUNTS_PAGE_CACHE_SECONDS = 60 * 60
+
+# Trends computed with numpy over the transactions of the range instead of the rollups
+ACCOUNTS_VECTORIZED_ANALYTICS = os.environ.get('ACCOUNTS_VECTORIZED_ANALYTICS') == '1'
+
+# Seconds without progress after which a running import is taken as left behind by a stopped worker and failed
+ACCOUNTS_IMPORT_JOB_TIMEOUT = 60 * 60
+
+# Reporting views run as async views, asgi.py turns this on
+ACCOUNTS_ASYNC_VIEWS = os.environ.get('ACCOUNTS_ASYNC_VIEWS') == '1'
+
+# Share of requests profiled, their SQL and timings are sent in a Server-Timing header
+ACCOUNTS_PROFILING_SAMPLE_RATE = float(os.environ.get('ACCOUNTS_PROFILING_SAMPLE_RATE', '0'))
+
+# Profiled requests are also logged as one JSON line each to the accounts.profiling logger
+ACCOUNTS_PROFILING_LOG = os.environ.get('ACCOUNTS_PROFILING_LOG') == '1'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'accounts.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -120,6 +168,10 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Uploaded statements wait here for the import worker
+MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_URL = '/media/'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 